@@ -6,29 +6,39 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 try:
-    from http.cookiejar import CookieJar
+    from http.cookiejar import Cookie, CookieJar
 except ImportError:
-    from cookielib import CookieJar
+    from cookielib import Cookie, CookieJar
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from http.client import parse_headers
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from httplib import HTTPMessage as parse_headers
 
 try:
     from urllib.parse import urlencode
+    from urllib.parse import urljoin
+    from urllib.parse import urlsplit
 except ImportError:
     from urllib import urlencode
+    from urlparse import urljoin
+    from urlparse import urlsplit
 
 try:
-    from urllib.request import urlopen
-    from urllib.request import build_opener
-    from urllib.request import install_opener
-    from urllib.request import HTTPCookieProcessor
     from urllib.request import Request
     from urllib.request import URLError
+    from urllib.request import HTTPError
 except ImportError:
-    from urllib2 import urlopen
-    from urllib2 import build_opener
-    from urllib2 import install_opener
-    from urllib2 import HTTPCookieProcessor
     from urllib2 import Request
     from urllib2 import URLError
+    from urllib2 import HTTPError
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
 
 # we alias the raw_input function for python 3 compatibility
 try:
@@ -37,23 +47,35 @@ except:
     pass
 
 import argparse
+import collections
+import contextlib
+import email.utils
+import errno
 import getpass
+import hashlib
+import io
 import json
 import os
 import os.path
+import random
 import re
 import sys
 import unicodedata
 import string
 import logging
+import math
 import re
-import youtube_dl
-import glob
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
 
 from subprocess import Popen, PIPE
-from datetime import timedelta, datetime
 
-from bs4 import BeautifulSoup
+# youtube_dl and bs4 are slow to import and not needed by every command
+# (e.g., --list-enrolled never downloads), so they are imported by the
+# functions that use them, see make_soup and get_youtube_dl
 
 OPENEDX_SITES = {
     'edx': {
@@ -73,6 +95,14 @@ COURSEWARE_SEL = OPENEDX_SITES['edx']['courseware-selector']
 
 YOUTUBE_VIDEO_ID_LENGTH = 11
 
+# the single scan extractor of extract_unit_videos: the 1.0 speed stream of
+# a video block (searched within its data-streams attribute), its transcript
+# and the videos embedded with an iframe
+UNIT_VIDEO_RE = re.compile(
+    r'data-(?:(?P<block>streams=(?:&#34;|")(?:[^"&]*?1\.0+:(?P<stream>[\w-]{11}))?)'
+    r'|transcript-translation-url=(?:&#34;|")(?P<transcript>[^"&]*)(?:&#34;|"))'
+    r'|//(?:www\.)?youtube\.com/embed/(?P<embed>[\w-]{11})')
+
 ## If nothing else is chosen, we chose the default user agent:
 
 DEFAULT_USER_AGENTS = {"chrome": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.31 (KHTML, like Gecko) Chrome/26.0.1410.63 Safari/537.31",
@@ -83,29 +113,778 @@ USER_AGENT = DEFAULT_USER_AGENTS["edx"]
 
 PY3 = ( sys.version_info >= (3,0) )
 
+# seconds to wait before retrying a failed download, doubled on every retry
+DOWNLOAD_RETRY_BACKOFF = 5
+
+PRINT_LOCK = threading.Lock()
+
+# seconds between two progress lines of the same download job
+PROGRESS_INTERVAL = 2
+
+PROGRESS_RE = re.compile(r'\[download\]\s+(?P<percent>\d+(?:\.\d+)?)%\s+of\s+~?\s*(?P<size>\S+)'
+                         r'(?:\s+at\s+(?P<speed>.+?)\s+ETA\s+(?P<eta>\S+))?')
+
+# per thread YoutubeDL instance of the in-process engine, see get_youtube_dl
+YOUTUBE_DL_LOCAL = threading.local()
+
+# seconds to wait for the OpenEdX site before giving up on a request
+HTTP_TIMEOUT = 60
+
+# status codes of OpenEdX responses worth retrying, see EdxSession.open
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# base and cap in seconds of the jittered exponential backoff of a retried
+# OpenEdX request, see retry_delay
+REQUEST_RETRY_BACKOFF = 1
+REQUEST_RETRY_MAX_DELAY = 60
+
+# requests per second the RequestGovernor starts probing the site from
+INITIAL_REQUEST_RATE = 20
+
+# cache of the video info and site pages, kept in the output dir
+CACHE_FILENAME = '.edx-dl-cache.sqlite'
+
+# fraction of its current speed a download slower than its share of the
+# --rate-limit budget may still grow by, see allocate_bandwidth
+BANDWIDTH_HEADROOM = 1.25
+
+# seconds a youtube-dl process runs at least before it is restarted at a new
+# share of the --rate-limit budget, and the change of its share (a fraction
+# of its rate) worth a restart, see BandwidthController.revise
+BANDWIDTH_RESTART_INTERVAL = 30
+BANDWIDTH_RESTART_CHANGE = 0.25
+
+# ioctl request cloning a file on the copy on write file systems of linux
+# (btrfs, xfs, ...), see reflink
+FICLONE = 0x40049409
+
+# per course record of the crawled units and downloaded files, see --sync
+MANIFEST_FILENAME = '.edx-dl-manifest.json'
+
+# logged-in cookies and CSRF token reused by the next runs, kept in the
+# home directory (not in the output dir, which may be shared) unless
+# --session-file says otherwise, see SessionStore
+SESSION_FILENAME = '.edx-dl-session.json'
+
+# attributes of a saved cookie, in the order of the Cookie constructor
+COOKIE_FIELDS = ('version', 'name', 'value', 'port', 'port_specified', 'domain',
+                 'domain_specified', 'domain_initial_dot', 'path', 'path_specified',
+                 'secure', 'expires', 'discard', 'comment', 'comment_url')
+
+# the session shared by all the requests to the OpenEdX site, see get_session
+SESSION = None
+
+# the umask of this process, applied to the files written by atomic_open
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+# times a queued job is claimed (failed or lost with its worker) before
+# the job queue gives up on it, see JobQueue
+QUEUE_MAX_ATTEMPTS = 3
+
 def bprint(data):
     if not isinstance(data, str):
         data = data.decode()
     print(data.strip())
 
-def youtube_get_filename(url, formatstr = None):
-    logging.debug('[debug] youtube_get_filename:%s, %s', url, formatstr )
-    ydl_options = {'outtmpl': '%(title)s.%(ext)s', 'nocheckcertificate': True}
-    if formatstr:
-        ydl_options['format'] = formatstr
-    ydl = youtube_dl.YoutubeDL(ydl_options)
-    # Add all the available extractors
-    ydl.add_default_info_extractors()
+def percentile(values, p):
+    """
+    Returns the nearest-rank p-th percentile of values.
+
+    >>> percentile([4, 1, 3, 2], 50)
+    2
+    >>> percentile(range(1, 101), 95)
+    95
+    """
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class Trace(object):
+    """
+    Thread safe record of the timed stages of a run: one event for each
+    login request, page fetch, video resolution, download and subtitle
+    fetch, with its duration, byte count and retries. See --trace.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.events = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, stage, **fields):
+        """
+        times the enclosed block as an event of stage, which the block can
+        update (e.g. its 'bytes' and 'retries')
+        """
+        event = dict(fields, stage=stage, bytes=0, retries=0, error=False)
+        start = time.time()
+        try:
+            yield event
+        except:
+            event['error'] = True
+            raise
+        finally:
+            event['start'] = start - self.start
+            event['duration'] = time.time() - start
+            with self._lock:
+                self.events.append(event)
+
+    def save(self, path):
+        """ writes the events as JSON to path """
+        with self._lock:
+            data = json.dumps({'wall_time': time.time() - self.start,
+                               'events': self.events}, indent=1, sort_keys=True)
+        with atomic_open(path, 'wb') as f:
+            f.write(data.encode('utf-8'))
+
+    def summary(self):
+        """ returns the lines of a per stage table of the events """
+        wall_time = time.time() - self.start
+        with self._lock:
+            events = list(self.events)
+        stages = collections.OrderedDict()
+        for event in sorted(events, key=lambda event: event['start']):
+            stages.setdefault(event['stage'], []).append(event)
+        lines = ['%-12s %6s %6s %7s %9s %9s %9s'
+                 % ('stage', 'count', 'errors', 'retries', 'p50 ms', 'p95 ms', 'MB')]
+        for (stage, stage_events) in stages.items():
+            durations = [event['duration'] * 1000 for event in stage_events]
+            lines.append('%-12s %6d %6d %7d %9.1f %9.1f %9.2f' % (
+                stage, len(stage_events),
+                sum(1 for event in stage_events if event['error']),
+                sum(event['retries'] for event in stage_events),
+                percentile(durations, 50), percentile(durations, 95),
+                sum(event['bytes'] for event in stage_events) / (1024.0 * 1024.0)))
+        total = sum(event['bytes'] for event in events) / (1024.0 * 1024.0)
+        lines.append('%.2f MB in %.1f s, %.2f MB/s'
+                     % (total, wall_time, total / wall_time if wall_time else 0))
+        return lines
+
+
+# the timed stages of this run, see --trace
+TRACE = Trace()
+
+
+class YoutubeDLLogger(object):
+    """ relays the messages of an in-process YoutubeDL tagged with the job """
+    def __init__(self):
+        self.tag = ''
+
+    def debug(self, msg):
+        job_print(self.tag, msg)
+
+    warning = error = debug
+
+
+def youtube_dl_progress_hook(status):
+    """
+    reports the progress of an in-process download to its job, and
+    revises its rate limit with its current speed
+    """
+    import youtube_dl
+    bandwidth = getattr(YOUTUBE_DL_LOCAL, 'bandwidth', None)
+    if bandwidth is not None and status.get('status') == 'downloading':
+        # youtube-dl reads the rate limit again before every block
+        YOUTUBE_DL_LOCAL.ydl.params['ratelimit'] = bandwidth.update(
+            YOUTUBE_DL_LOCAL.key, status.get('speed'))
+    progress = getattr(YOUTUBE_DL_LOCAL, 'progress', None)
+    if progress is None or status.get('status') not in ('downloading', 'finished'):
+        return
+    total = status.get('total_bytes') or status.get('total_bytes_estimate')
+    done = status.get('downloaded_bytes') or 0
+    speed = status.get('speed')
+    eta = status.get('eta')
+    progress.update({
+        'percent': 100.0 if status['status'] == 'finished'
+                   else 100.0 * done / total if total else 0.0,
+        'size': youtube_dl.utils.format_bytes(total) if total else None,
+        'speed': youtube_dl.utils.format_bytes(speed) + '/s' if speed else None,
+        'eta': '%02d:%02d' % divmod(eta, 60) if eta is not None else None,
+    })
+
+def get_youtube_dl():
+    """
+    Returns the YoutubeDL instance of the current thread. It is created the
+    first time it is needed and reused for the rest of the run, so the
+    extractors are only set up once per thread.
+    """
+    ydl = getattr(YOUTUBE_DL_LOCAL, 'ydl', None)
+    if ydl is None:
+        import youtube_dl
+        ydl = youtube_dl.YoutubeDL({'outtmpl': '%(title)s.%(ext)s',
+                                    'nocheckcertificate': True,
+                                    'logger': YoutubeDLLogger(),
+                                    'noprogress': True,
+                                    'progress_hooks': [youtube_dl_progress_hook]})
+        # Add all the available extractors
+        ydl.add_default_info_extractors()
+        YOUTUBE_DL_LOCAL.ydl = ydl
+    return ydl
+
+def youtube_get_info(url, formatstr = None, subtitles = False):
+    """ returns the info dict youtube-dl resolves for the video at url """
+    logging.debug('[debug] youtube_get_info:%s, %s', url, formatstr )
+    ydl = get_youtube_dl()
+    ydl.params['outtmpl'] = '%(title)s.%(ext)s'
+    ydl.params['format'] = formatstr
+    ydl.params['writesubtitles'] = subtitles
 
     result = ydl.extract_info(url, download=False)
 
     if 'entries' in result:
         # Can be a playlist or a list of videos
-        video = result['entries'][0]
-    else:
-        # Just a video
-        video = result
-    return ydl.prepare_filename(video).encode("utf-8")
+        return result['entries'][0]
+    # Just a video
+    return result
+
+def youtube_info_filename(video):
+    """ returns the title.ext filename youtube-dl gives to the video """
+    ydl = get_youtube_dl()
+    ydl.params['outtmpl'] = '%(title)s.%(ext)s'
+    return ydl.prepare_filename(video)
+
+def youtube_get_filename(url, formatstr = None):
+    logging.debug('[debug] youtube_get_filename:%s, %s', url, formatstr )
+    return youtube_info_filename(youtube_get_info(url, formatstr)).encode("utf-8")
+
+class MetadataCache(object):
+    """
+    SQLite cache of the video info resolved by youtube-dl, keyed by video id
+    and format, so re-runs do not extract the info of every video again.
+    Entries older than ttl seconds are ignored and dropped, and only the
+    max_entries most recently used entries are kept.
+
+    >>> cache = MetadataCache(':memory:', ttl=3600)
+    >>> cache.get('abc', '22/mp4') is None
+    True
+    >>> cache.put('abc', '22/mp4', {'title': 'Intro', 'ext': 'mp4'}, 'Intro.mp4')
+    >>> bprint(cache.get('abc', '22/mp4')['filename'])
+    Intro.mp4
+    >>> cache.get('abc', None) is None
+    True
+    """
+    def __init__(self, path, ttl, max_entries=10000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS videos (
+                video_id TEXT, format TEXT, title TEXT, ext TEXT,
+                filename TEXT, formats TEXT, created REAL, used REAL,
+                PRIMARY KEY (video_id, format))""")
+            self._conn.execute('DELETE FROM videos WHERE created < ?',
+                               (time.time() - self.ttl,))
+            self._conn.commit()
+        return self._conn
+
+    def get(self, video_id, formatstr):
+        """ returns the cached entry of the video or None """
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            row = db.execute("""SELECT title, ext, filename, formats
+                FROM videos WHERE video_id = ? AND format = ? AND created >= ?""",
+                (video_id, formatstr or '', now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE videos SET used = ? WHERE video_id = ? AND format = ?',
+                       (now, video_id, formatstr or ''))
+            db.commit()
+        return {'title': row[0], 'ext': row[1], 'filename': row[2],
+                'formats': json.loads(row[3])}
+
+    def put(self, video_id, formatstr, info, filename):
+        """ stores the resolved info of the video, evicting old entries """
+        formats = [{'format_id': f.get('format_id'), 'ext': f.get('ext'),
+                    'format': f.get('format')} for f in info.get('formats') or []]
+        now = time.time()
+        with self._lock:
+            db = self._db()
+            db.execute('INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       (video_id, formatstr or '', info.get('title'),
+                        info.get('ext'), filename, json.dumps(formats), now, now))
+            db.execute("""DELETE FROM videos WHERE rowid IN (SELECT rowid
+                FROM videos ORDER BY used DESC LIMIT -1 OFFSET ?)""",
+                (self.max_entries,))
+            db.commit()
+
+def resolve_video(video_id, url, formatstr, subtitles, cache=None):
+    """
+    Returns (filename, info) for the video, where filename is the title.ext
+    name given by youtube-dl. On a cache hit no extraction is done and info
+    is None.
+    """
+    if cache is not None:
+        cached = cache.get(video_id, formatstr)
+        if cached is not None:
+            logging.debug('[debug] metadata cache hit:%s, %s', video_id, formatstr)
+            return (cached['filename'], None)
+    with TRACE.span('resolve', video_id=video_id):
+        info = youtube_get_info(url, formatstr, subtitles)
+    filename = youtube_info_filename(info)
+    if cache is not None:
+        cache.put(video_id, formatstr, info, filename)
+    return (filename, info)
+
+def file_sha1(path, blocksize=1 << 20):
+    """ returns the hex SHA-1 digest of the file at path """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_size(path):
+    """ returns the size of the file at path, or 0 if there is none """
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def file_damage(path, entry, check_hash=False):
+    """
+    returns None if the file at path still has the size (and, if
+    check_hash, the SHA-1) recorded in entry, else 'missing', 'truncated'
+    or 'corrupt'
+    """
+    if not os.path.isfile(path):
+        return 'missing'
+    size = os.path.getsize(path)
+    if size < entry['size']:
+        return 'truncated'
+    if size != entry['size'] or (check_hash and file_sha1(path) != entry['sha1']):
+        return 'corrupt'
+    return None
+
+
+def replace_file(src, dst):
+    """ renames src to dst, replacing dst if it exists """
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # python 2 has no os.replace
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w', permissions=None, **kwargs):
+    """
+    Opens a temporary file next to path, which replaces path only once it
+    was written completely. An interrupted write leaves path untouched.
+    Every writer gets a temporary file of its own, so that processes
+    writing path at the same time do not mix their writes. The file is
+    created with the given permissions if any.
+    """
+    (fd, tmp_path) = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                      suffix='.tmp',
+                                      dir=os.path.dirname(path) or '.')
+    try:
+        # mkstemp creates the file only readable by its owner
+        os.chmod(tmp_path, permissions if permissions is not None else 0o666 & ~UMASK)
+        with io.open(fd, mode, **kwargs) as f:
+            yield f
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    replace_file(tmp_path, path)
+
+
+def discard_damaged_video(path, damage):
+    """
+    Gets the damaged video file at path out of the way of youtube-dl. A
+    truncated file becomes the partial download youtube-dl resumes with a
+    range request, anything else is removed and downloaded again.
+    """
+    logging.warning('[warning] %s video, downloading it again: %s'
+                    % (damage.capitalize(), path))
+    part_path = path + '.part'
+    # resuming a hard linked copy would append to the other copies too
+    if damage == 'truncated' and not os.path.exists(part_path) and \
+            os.stat(path).st_nlink == 1:
+        os.rename(path, part_path)
+    elif damage != 'missing':
+        os.remove(path)
+
+
+def reflink(src, dst):
+    """
+    Makes dst a copy on write clone of src, sharing its data blocks. Raises
+    OSError where the file system (or the platform) does not support it.
+    """
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are only supported on linux')
+    import fcntl
+    with open(src, 'rb') as source:
+        with open(dst, 'wb') as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+
+
+def link_file(src, dst, method='auto'):
+    """
+    Makes dst a copy of src without downloading it again and returns how:
+    'reflink' (a clone sharing the data blocks of src), 'hardlink' or
+    'copy'. With method 'auto' the first of them the file system supports
+    is used, else only method is tried.
+    """
+    import shutil
+    methods = ['reflink', 'hardlink', 'copy'] if method == 'auto' else [method]
+    tmp_path = dst + '.tmp'
+    for name in methods:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            if name == 'reflink':
+                reflink(src, tmp_path)
+            elif name == 'hardlink':
+                os.link(src, tmp_path)
+            else:
+                shutil.copyfile(src, tmp_path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if name == methods[-1]:
+                raise
+            continue
+        replace_file(tmp_path, dst)
+        return name
+
+
+class ContentIndex(object):
+    """
+    SQLite index of the videos downloaded under the output dir of all the
+    courses, keyed by video id and format, so that a video found in several
+    units, weeks or courses (e.g., the reruns of a course) is downloaded
+    once and its other occurrences are linked to that copy. Paths are kept
+    relative to the directory of the index, and an entry whose file is gone
+    or changed size is dropped when it is looked up.
+
+    >>> index = ContentIndex(':memory:')
+    >>> index.find('abc', '22/mp4') is None
+    True
+    """
+    def __init__(self, path):
+        self.path = path
+        self.base = os.path.dirname(os.path.abspath(path))
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.')
+            except OSError:
+                # already there, maybe created by a download meanwhile
+                pass
+            self._conn = sqlite3.connect(self.path, timeout=30,
+                                         check_same_thread=False)
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS contents (
+                video_id TEXT, format TEXT, path TEXT, size INTEGER,
+                PRIMARY KEY (video_id, format))""")
+        return self._conn
+
+    def find(self, video_id, formatstr):
+        """ returns the path of the downloaded copy of the video or None """
+        with self._lock:
+            db = self._db()
+            row = db.execute("""SELECT path, size FROM contents
+                WHERE video_id = ? AND format = ?""",
+                (video_id, formatstr or '')).fetchone()
+            if row is None:
+                return None
+            path = os.path.join(self.base, row[0])
+            if file_size(path) == row[1]:
+                return path
+            db.execute('DELETE FROM contents WHERE video_id = ? AND format = ?',
+                       (video_id, formatstr or ''))
+            db.commit()
+        return None
+
+    def add(self, video_id, formatstr, path):
+        """ records path as the downloaded copy of the video """
+        with self._lock:
+            db = self._db()
+            db.execute('INSERT OR REPLACE INTO contents VALUES (?, ?, ?, ?)',
+                       (video_id, formatstr or '',
+                        os.path.relpath(os.path.abspath(path), self.base),
+                        os.path.getsize(path)))
+            db.commit()
+
+
+def dedup_video(job, contents, method):
+    """
+    Materializes the video of job from the copy recorded in the content
+    index contents, if there is one, with link_file. Returns False if the
+    video must be downloaded.
+    """
+    if os.path.isfile(job['filename']):
+        # youtube-dl checks the existing file itself
+        return False
+    source = contents.find(job['video_id'], job['format'])
+    if source is None:
+        return False
+    try:
+        os.makedirs(job['target_dir'])
+    except OSError:
+        # already there, maybe created by youtube-dl or the subtitles meanwhile
+        pass
+    try:
+        with TRACE.span('dedup', video_id=job['video_id']):
+            used = link_file(source, job['filename'], method)
+    except (IOError, OSError) as e:
+        logging.warning('[warning] %s Cannot link %s (%s), downloading it'
+                        % (job['tag'], source, e))
+        return False
+    if os.path.exists(job['filename'] + '.part'):
+        os.remove(job['filename'] + '.part')
+    job_print(job['tag'], '[dedup] %s of %s' % (used, source))
+    return True
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Holds an exclusive lock on the file path + '.lock' (created if needed)
+    that other processes (and threads) taking the same lock wait for. There
+    is no such lock where fcntl is missing (windows).
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def read_manifest(path):
+    """
+    returns the data of the manifest at path, or an empty manifest if
+    there is none or it cannot be read
+    """
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logging.warning('[warning] Ignoring the unreadable manifest %s (%s)' % (path, e))
+        return {}
+
+
+class CourseManifest(object):
+    """
+    Per course record of what was already crawled and downloaded: the
+    video ids and subtitle URLs found in every unit page (with a checksum
+    of the page), the path, size and checksum of every downloaded video,
+    keyed by its week folder and numeric prefix, and the size and checksum
+    of every subtitle file. Paths are kept relative to the course folder,
+    so the output dir may be moved or mounted elsewhere. It is what lets
+    --sync skip unchanged work and what finds damaged files.
+
+    Other processes (see --worker) may save the same manifest: saving
+    only writes over the saved entries what this one recorded since its
+    last save, and reloads the others.
+    """
+    SECTIONS = ('units', 'files', 'subtitles')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        data = read_manifest(path)
+        self.units = data.get('units', {})
+        self.files = data.get('files', {})
+        self.subtitles = data.get('subtitles', {})
+        # keys recorded or removed since the last save, per section
+        self._changed = dict((name, set()) for name in self.SECTIONS)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # the lock keeps other processes from saving between the read and
+        # the write, which would lose what they recorded
+        with self._lock, file_lock(self.path):
+            data = read_manifest(self.path)
+            for name in self.SECTIONS:
+                entries = data.setdefault(name, {})
+                for key in self._changed[name]:
+                    if key in getattr(self, name):
+                        entries[key] = getattr(self, name)[key]
+                    else:
+                        entries.pop(key, None)
+            with atomic_open(self.path, 'wb') as f:
+                f.write(json.dumps(dict((name, data[name]) for name in self.SECTIONS),
+                                   indent=1, sort_keys=True).encode('utf-8'))
+            for name in self.SECTIONS:
+                setattr(self, name, data[name])
+                self._changed[name] = set()
+
+    def _relative(self, path):
+        """ returns path relative to the course folder, as it is recorded """
+        return os.path.relpath(path, os.path.dirname(self.path) or '.')
+
+    def _full(self, path):
+        """ returns the path of a file recorded relative to the course folder """
+        return os.path.join(os.path.dirname(self.path), path)
+
+    def record_unit(self, url, video_ids, subs_urls, sha1):
+        with self._lock:
+            self.units[url] = {'video_ids': video_ids, 'subs_urls': subs_urls,
+                               'sha1': sha1}
+            self._changed['units'].add(url)
+
+    def record_file(self, key, video_id, path):
+        """ records the video downloaded at path and saves the manifest """
+        entry = {'video_id': video_id, 'path': self._relative(path),
+                 'size': os.path.getsize(path), 'sha1': file_sha1(path)}
+        with self._lock:
+            self.files[key] = entry
+            self._changed['files'].add(key)
+        self.save()
+
+    def record_subtitle(self, path):
+        """ records the subtitle file written at path """
+        entry = {'size': os.path.getsize(path), 'sha1': file_sha1(path)}
+        with self._lock:
+            self.subtitles[self._relative(path)] = entry
+            self._changed['subtitles'].add(self._relative(path))
+
+    def rename_subtitle(self, old_path, path):
+        """ moves the record of the subtitle file renamed to path """
+        with self._lock:
+            entry = self.subtitles.pop(self._relative(old_path), None)
+            if entry is not None:
+                self.subtitles[self._relative(path)] = entry
+                self._changed['subtitles'].update([self._relative(old_path),
+                                                   self._relative(path)])
+
+    def video_damage(self, key, video_id, check_hash=False):
+        """
+        returns the damage (see file_damage) of the file of the video
+        recorded under key, or None if it is intact or was not recorded
+        """
+        entry = self.files.get(key)
+        if not entry or entry['video_id'] != video_id:
+            return None
+        return file_damage(self._full(entry['path']), entry, check_hash)
+
+    def video_path(self, key):
+        """ returns the path of the video file recorded under key """
+        return self._full(self.files[key]['path'])
+
+    def subtitle_intact(self, path, check_hash=False):
+        """
+        returns True if the subtitle file at path exists and, if it was
+        recorded, still has its recorded size (and checksum)
+        """
+        entry = self.subtitles.get(self._relative(path))
+        if entry is None:
+            return os.path.isfile(path)
+        return file_damage(path, entry, check_hash) is None
+
+    def is_complete(self, key, video_id, subs_url, subtitle_langs=(),
+                    subtitle_format='srt', check_hash=False):
+        """
+        returns True if the video was recorded under key and its file is
+        still there with the recorded size (and checksum, if check_hash),
+        and so are its subtitles in the given languages and format, which
+        only videos with an edX transcript (a subs_url) have
+        """
+        entry = self.files.get(key)
+        if not entry or entry['video_id'] != video_id:
+            return False
+        path = self._full(entry['path'])
+        if file_damage(path, entry, check_hash):
+            return False
+        if not subs_url:
+            return True
+        return all(self.subtitle_intact(subs_path, check_hash)
+                   for (lang, subs_path) in subtitle_paths(path, subtitle_langs,
+                                                           subtitle_format))
+
+
+class DirectoryIndex(object):
+    """
+    In-memory index of the files of a week folder, listed once and kept up
+    to date as files are written or renamed there. Files are keyed by their
+    name and by title (the name without its numeric prefix), so finding a
+    video saved under another prefix or checking for its subtitles needs no
+    further directory scans.
+
+    >>> index = DirectoryIndex('/nonexistent')
+    >>> index.add('/nonexistent/03-Intro.mp4')
+    >>> '/nonexistent/03-Intro.mp4' in index
+    True
+    >>> bprint(index.find('Intro.mp4', 2)['03'])
+    /nonexistent/03-Intro.mp4
+    >>> index.find('Intro.mp4', 3)
+    {}
+    """
+    def __init__(self, path):
+        self.path = path
+        self._names = set()
+        self._titles = {}
+        self._lock = threading.Lock()
+        try:
+            names = os.listdir(path)
+        except OSError:
+            names = []
+        for name in names:
+            self._add(name)
+
+    def _add(self, name):
+        self._names.add(name)
+        (prefix, sep, title) = name.partition('-')
+        if sep and prefix.isdigit():
+            self._titles.setdefault(title, {})[prefix] = name
+
+    def _remove(self, name):
+        self._names.discard(name)
+        (prefix, sep, title) = name.partition('-')
+        self._titles.get(title, {}).pop(prefix, None)
+
+    def __contains__(self, path):
+        with self._lock:
+            return os.path.basename(path) in self._names
+
+    def add(self, path):
+        """ records the file written at path """
+        with self._lock:
+            self._add(os.path.basename(path))
+
+    def rename(self, old_path, path):
+        """ renames the file at old_path to path """
+        replace_file(old_path, path)
+        with self._lock:
+            self._remove(os.path.basename(old_path))
+            self._add(os.path.basename(path))
+
+    def find(self, title, prefix_length):
+        """
+        returns {prefix: path} for the files named title after a numeric
+        prefix of prefix_length digits
+        """
+        with self._lock:
+            names = dict(self._titles.get(title, {}))
+        return dict((prefix, os.path.join(self.path, name))
+                    for (prefix, name) in names.items()
+                    if len(prefix) == prefix_length)
+
 
 def validate_filename(filename, default_name=""):
     """
@@ -170,6 +949,488 @@ def change_openedx_site(site_name):
     DASHBOARD = BASE_URL + '/dashboard'
     COURSEWARE_SEL = OPENEDX_SITES[site_name]['courseware-selector']
 
+class SessionResponse(object):
+    """
+    A fully read HTTP response, exposing the parts of the urlopen response
+    interface used by this script and by the cookie jar.
+    """
+    def __init__(self, url, status, reason, msg, body):
+        self.url = url
+        self.code = status
+        self.reason = reason
+        self.headers = msg
+        self.body = body
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def read(self):
+        return self.body
+
+
+class PageCache(object):
+    """
+    SQLite cache of the pages fetched with GET, keyed by URL. The ETag and
+    Last-Modified validators are kept so that a page can be revalidated
+    with a conditional request, and the least recently used pages are
+    evicted once the bodies add up to more than max_size bytes.
+    """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.')
+            except OSError:
+                # already there, maybe created by a download meanwhile
+                pass
+            self._conn = sqlite3.connect(self.path, timeout=30,
+                                         check_same_thread=False)
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT,
+                content_type TEXT, body BLOB, size INTEGER, used REAL)""")
+        return self._conn
+
+    def get(self, url):
+        """ returns (response, etag, last_modified) for url or None """
+        with self._lock:
+            db = self._db()
+            row = db.execute("""SELECT etag, last_modified, content_type, body
+                FROM pages WHERE url = ?""", (url,)).fetchone()
+            if row is None:
+                return None
+            db.execute('UPDATE pages SET used = ? WHERE url = ?', (time.time(), url))
+            db.commit()
+        (etag, last_modified, content_type, body) = row
+        raw_headers = 'Content-Type: %s\r\n\r\n' % content_type
+        headers = parse_headers(io.BytesIO(raw_headers.encode('latin-1')))
+        response = SessionResponse(url, 200, 'OK', headers, bytes(body))
+        return (response, etag, last_modified)
+
+    def bodies(self, url_pattern='%'):
+        """ returns the decoded bodies of the pages whose URL is LIKE url_pattern """
+        with self._lock:
+            rows = self._db().execute('SELECT body FROM pages WHERE url LIKE ?',
+                                      (url_pattern,)).fetchall()
+        return [bytes(row[0]).decode('utf-8', 'replace') for row in rows]
+
+    def put(self, url, response):
+        """ stores the response of url and evicts the oldest pages if needed """
+        headers = response.headers
+        with self._lock:
+            db = self._db()
+            db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                       (url, headers.get('ETag'), headers.get('Last-Modified'),
+                        headers.get('Content-Type', 'text/html'),
+                        sqlite3.Binary(response.body), len(response.body),
+                        time.time()))
+            total = 0
+            evicted = []
+            for (page_url, size) in db.execute('SELECT url, size FROM pages ORDER BY used DESC'):
+                total += size
+                if total > self.max_size:
+                    evicted.append((page_url,))
+            db.executemany('DELETE FROM pages WHERE url = ?', evicted)
+            db.commit()
+
+
+class SessionStore(object):
+    """
+    File of the logged-in sessions, keyed by site and user, that later
+    runs resume instead of logging in again. Every session is the cookie
+    jar and the CSRF token the site gave after the login. The file is only
+    readable by its owner since the cookies give access to the account.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def load(self, username, cookies):
+        """
+        Adds the unexpired saved cookies of username to the cookies jar and
+        returns the saved CSRF token, or None if there is no session to
+        resume. Without a username the latest session saved for the site
+        is resumed.
+        """
+        sessions = self._read()
+        if username is None:
+            saved = [v for k, v in sessions.items() if k.startswith(BASE_URL + ' ')]
+            saved = max(saved, key=lambda v: v.get('saved', 0)) if saved else None
+        else:
+            saved = sessions.get(BASE_URL + ' ' + username)
+        if not saved:
+            return None
+        now = time.time()
+        resumed = 0
+        for fields in saved['cookies']:
+            cookie = Cookie(*[fields[name] for name in COOKIE_FIELDS],
+                            rest=fields.get('rest', {}))
+            if not cookie.is_expired(now):
+                cookies.set_cookie(cookie)
+                resumed += 1
+        return saved['csrftoken'] if resumed else None
+
+    def save(self, username, cookies, csrftoken):
+        """ saves the cookies and CSRF token of username, keeping the other sessions """
+        sessions = self._read()
+        saved = []
+        for cookie in cookies:
+            fields = dict((name, getattr(cookie, name)) for name in COOKIE_FIELDS)
+            fields['rest'] = dict(getattr(cookie, '_rest', {}))
+            saved.append(fields)
+        sessions[BASE_URL + ' ' + username] = {'csrftoken': csrftoken, 'cookies': saved,
+                                               'saved': time.time()}
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        data = json.dumps(sessions, indent=1, sort_keys=True)
+        with atomic_open(self.path, 'wb', permissions=0o600) as f:
+            f.write(data.encode('utf-8'))
+
+
+def redirected_to_login(url, response):
+    """
+    True if the request of url was redirected to the login page, which is
+    how the site answers requests of a session it no longer accepts.
+    """
+    return response.url != url and urlsplit(response.url).path.startswith('/login')
+
+
+def parse_retry_after(value):
+    """
+    Returns the seconds to wait given by a Retry-After header value (a
+    number of seconds or an HTTP date), or None.
+
+    >>> parse_retry_after('120')
+    120.0
+    >>> parse_retry_after('Thu, 01 Jan 1970 00:00:00 GMT')
+    0.0
+    >>> parse_retry_after(None) is None
+    True
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+def retry_delay(attempt, retry_after=None):
+    """
+    Returns the seconds to wait before retry number attempt (from 0) of a
+    request: a random delay up to an exponentially growing bound (full
+    jitter, so concurrent requests do not retry in lockstep), but at least
+    retry_after.
+    """
+    bound = min(REQUEST_RETRY_MAX_DELAY, REQUEST_RETRY_BACKOFF * 2 ** attempt)
+    return max(random.uniform(0, bound), retry_after or 0)
+
+
+def prepare_request(session, url, data, headers, cache):
+    """
+    Returns (request_headers, cache, cached) for a request of session (an
+    EdxSession or an AsyncSession) to url: the session headers updated with
+    headers and the validators of the cached page, whether the response
+    goes to the page cache, and the (response, etag, last_modified) of the
+    page cache or None. Raises URLError for a page not in the page cache
+    of an offline session.
+    """
+    request_headers = dict(session.headers)
+    request_headers.update(headers or {})
+    cache = cache and data is None and session.page_cache is not None
+    cached = session.page_cache.get(url) if cache else None
+    if session.offline and cached is None:
+        raise URLError('%s is not in the page cache (offline)' % url)
+    if cached is not None:
+        (_, etag, last_modified) = cached
+        if etag:
+            request_headers['If-None-Match'] = etag
+        if last_modified:
+            request_headers['If-Modified-Since'] = last_modified
+    return (request_headers, cache, cached)
+
+
+def retry_wait(session, url, response, error, attempt):
+    """
+    Reports the outcome of attempt (from 0) of a request of session to url
+    (its response, or the URLError raised) to the session governor.
+    Returns the seconds to wait before retrying it, or None if it is done.
+    """
+    retry_after = None
+    if response is not None and response.code in RETRY_STATUS:
+        retry_after = parse_retry_after(response.headers.get('Retry-After'))
+        if response.code in (429, 503) and session.governor is not None:
+            session.governor.throttled(retry_after)
+    elif response is not None and session.governor is not None:
+        session.governor.success()
+    if (response is not None and response.code not in RETRY_STATUS) or \
+            attempt >= session.retries:
+        return None
+    delay = retry_delay(attempt, retry_after)
+    logging.warning('[warning] %s (%s), retrying in %.1f seconds'
+                    % (url, error or response.code, delay))
+    return delay
+
+
+def finish_response(session, url, response, error, attempt, cache, cached):
+    """
+    Returns the response of the last attempt of a request of session to
+    url, or the cached one if the page is not modified, and stores it in
+    the page cache if cache is True. Raises the URLError of the attempt,
+    or HTTPError for an error status code or a redirection to the login
+    page.
+    """
+    if error is not None:
+        raise error
+    response.retries = attempt
+    if response.code == 304 and cached is not None:
+        logging.debug("[debug] not modified: " + url)
+        return cached[0]
+    if redirected_to_login(url, response):
+        raise HTTPError(response.url, 401, 'Redirected to the login page',
+                        response.headers, None)
+    if response.code >= 400:
+        raise HTTPError(response.url, response.code, response.reason,
+                        response.headers, None)
+    if cache and response.code == 200:
+        session.page_cache.put(url, response)
+    return response
+
+
+class RequestGovernor(object):
+    """
+    Adaptive rate limit shared by all the requests of a session: a token
+    bucket refilled at rate requests per second. While the requests use up
+    the bucket and the site answers, the rate grows: by two requests/s per
+    answer until the site first throttles, then additively by about one
+    request/s per second. It never goes above max_rate, if any. Whenever
+    the site throttles with a 429 or 503, the rate is halved (down to
+    min_rate, at most once a second), and a Retry-After holds every
+    request until it has passed.
+
+    >>> governor = RequestGovernor(rate=6)
+    >>> governor.reserve()
+    0
+    >>> governor.success()
+    >>> governor.rate
+    8.0
+    >>> governor.throttled()
+    >>> governor.rate
+    4.0
+    >>> governor.success()
+    >>> governor.rate
+    4.25
+    >>> RequestGovernor(max_rate=2).rate
+    2.0
+    """
+    def __init__(self, max_rate=None, rate=INITIAL_REQUEST_RATE, min_rate=0.5):
+        self.max_rate = float(max_rate) if max_rate else float('inf')
+        self.min_rate = min(min_rate, self.max_rate)
+        self.rate = min(float(rate), self.max_rate)
+        self._tokens = 1.0
+        self._updated = time.time()
+        self._paused_until = 0
+        self._decreased = 0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        takes a token and returns 0 if a request may be sent now, else
+        returns the seconds to wait before trying again
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(max(1.0, self.rate),
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._paused_until > now:
+                return self._paused_until - now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """ waits until the next request may be sent """
+        wait = self.reserve()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.reserve()
+
+    def success(self):
+        """
+        increases the rate if the requests are held by it, by two requests/s
+        per answer before the first throttle and by 1/rate after it (about
+        one request/s per second)
+        """
+        with self._lock:
+            if self._tokens >= 1:
+                return
+            step = 2.0 if not self._decreased else 1.0 / self.rate
+            self.rate = min(self.max_rate, self.rate + step)
+
+    def throttled(self, retry_after=None):
+        """ multiplicative decrease, and a pause of retry_after seconds """
+        with self._lock:
+            now = time.time()
+            if now - self._decreased >= 1:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._tokens = 0
+                self._decreased = now
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+
+
+class EdxSession(object):
+    """
+    HTTP session used for every request to the OpenEdX site. It holds the
+    cookie jar, the CSRF token and the default headers, and keeps idle
+    connections alive in a pool so that a crawl of hundreds of pages does
+    not pay a TCP+TLS handshake per page. It is safe to use from several
+    threads: each request borrows a connection of its own from the pool.
+    """
+    MAX_REDIRECTS = 10
+
+    def __init__(self, headers=None):
+        self.cookies = CookieJar()
+        self.csrftoken = ''
+        self.headers = dict(headers or {})
+        self.page_cache = None
+        self.offline = False
+        self.governor = None
+        self.bandwidth = None
+        self.retries = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _acquire(self, scheme, netloc):
+        """ returns (connection, reused) for the given host """
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return (idle.pop(), True)
+        connection_class = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return (connection_class(netloc, timeout=HTTP_TIMEOUT), False)
+
+    def _release(self, scheme, netloc, connection):
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(connection)
+
+    def close(self):
+        """ closes all the idle connections of the pool """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def get_cookie(self, name):
+        for cookie in self.cookies:
+            if cookie.name == name:
+                return cookie.value
+        return None
+
+    def _send(self, request):
+        """ sends request over a pooled connection and reads the response """
+        (scheme, netloc, path, query, fragment) = urlsplit(request.get_full_url())
+        selector = (path or '/') + ('?' + query if query else '')
+        self.cookies.add_cookie_header(request)
+        headers = dict(request.header_items())
+        method = 'POST' if request.data is not None else 'GET'
+        while True:
+            (connection, reused) = self._acquire(scheme, netloc)
+            try:
+                connection.request(method, selector, request.data, headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (HTTPException, socket.error) as e:
+                connection.close()
+                if reused:
+                    # the server closed the idle connection, try a new one
+                    continue
+                raise URLError(e)
+            break
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(scheme, netloc, connection)
+        result = SessionResponse(request.get_full_url(), response.status,
+                                 response.reason, response.msg, body)
+        self.cookies.extract_cookies(result, request)
+        return result
+
+    def _follow(self, url, data, headers):
+        """ sends the request and follows its redirections """
+        for _ in range(self.MAX_REDIRECTS + 1):
+            response = self._send(Request(url, data, headers))
+            location = response.headers.get('Location')
+            if response.code not in (301, 302, 303, 307, 308) or not location:
+                break
+            url = urljoin(url, location)
+            if response.code in (301, 302, 303):
+                data = None
+        return response
+
+    def open(self, url, data=None, headers=None, cache=True):
+        """
+        Request url (a POST if data is given, else a GET) with the session
+        headers updated with headers, following redirections. Like urlopen,
+        raises HTTPError for error status codes and URLError if the site
+        cannot be reached. GET responses go through the page cache unless
+        cache is False. Requests wait for the governor, if any, and are
+        retried up to retries times with jittered exponential backoff when
+        the site cannot be reached or answers with a RETRY_STATUS. The bytes
+        received are taken from the bandwidth controller, if any, waiting
+        when its budget is spent.
+        """
+        (request_headers, cache, cached) = prepare_request(self, url, data, headers, cache)
+        if self.offline:
+            return cached[0]
+        attempt = 0
+        while True:
+            if self.governor is not None:
+                self.governor.acquire()
+            (response, error) = (None, None)
+            try:
+                response = self._follow(url, data, request_headers)
+            except URLError as e:
+                error = e
+            if response is not None and self.bandwidth is not None:
+                time.sleep(self.bandwidth.reserve(len(response.body)))
+            delay = retry_wait(self, url, response, error, attempt)
+            if delay is None:
+                break
+            time.sleep(delay)
+            attempt += 1
+        return finish_response(self, url, response, error, attempt, cache, cached)
+
+
+def get_session():
+    """ returns the session shared by all the requests to the site """
+    global SESSION
+    if SESSION is None:
+        SESSION = EdxSession()
+    return SESSION
+
+
 def get_initial_token():
     """
     Create initial connection to get authentication token for future requests.
@@ -178,61 +1439,366 @@ def get_initial_token():
     X-CSRFToken header or the empty string if we didn't find any token in
     the cookies.
     """
-    cj = CookieJar()
-    opener = build_opener(HTTPCookieProcessor(cj))
-    install_opener(opener)
-    opener.open(EDX_HOMEPAGE)
+    session = get_session()
+    # never revalidated, the token comes in the cookies of a full response
+    with TRACE.span('login', url=EDX_HOMEPAGE) as event:
+        event['bytes'] = len(session.open(EDX_HOMEPAGE, cache=False).read())
+    session.csrftoken = session.get_cookie('csrftoken') or ''
+    return session.csrftoken
 
-    for cookie in cj:
-        if cookie.name == 'csrftoken':
-            return cookie.value
 
-    return ''
+def login(username, password, headers):
+    """
+    Log the session in with the credentials of the user, setting the
+    X-CSRFToken of headers and of the session. Exits if the site refuses
+    the credentials.
+    """
+    session = get_session()
+    headers['X-CSRFToken'] = get_initial_token()
+    session.headers.update(headers)
+    post_data = urlencode({'email': username, 'password': password,
+                           'remember': False}).encode('utf-8')
+    with TRACE.span('login', url=LOGIN_API) as event:
+        body = session.open(LOGIN_API, post_data, headers).read()
+        event['bytes'] = len(body)
+    resp = json.loads(body.decode('utf-8'))
+    if not resp.get('success', False):
+        logging.error(resp.get('value', "Wrong Email or Password."))
+        exit(2)
 
 
-def get_page_contents(url, headers):
+def resume_session(store, username, headers):
+    """
+    Load the session of the user saved in store by a previous run into the
+    session, setting the X-CSRFToken of headers. Returns False if there is
+    no saved session to resume. Whether the site still accepts it is only
+    known from the next request.
+    """
+    session = get_session()
+    csrftoken = store.load(username, session.cookies)
+    if csrftoken is None:
+        return False
+    logging.debug('[debug] resuming the saved session of %s' % (username or 'the last user'))
+    session.csrftoken = csrftoken
+    headers['X-CSRFToken'] = csrftoken
+    session.headers.update(headers)
+    return True
+
+
+def get_page_contents(url, headers, stage='page'):
     """
     Get the contents of the page at the URL given by url. While making the
-    request, we use the headers given in the dictionary in headers.
+    request, we use the headers given in the dictionary in headers. The
+    request is timed as an event of stage.
     """
     logging.debug("[debug] url = " + url)
-    result = urlopen(Request(url, None, headers))
-    try:
-        charset = result.headers.get_content_charset(failobj="utf-8")  # for python3
-    except:
-        charset = result.info().getparam('charset') or 'utf-8'
-    return result.read().decode(charset)
+    with TRACE.span(stage, url=url) as event:
+        result = get_session().open(url, None, headers)
+        try:
+            charset = result.headers.get_content_charset(failobj="utf-8")  # for python3
+        except:
+            charset = result.info().getparam('charset') or 'utf-8'
+        body = result.read()
+        event['bytes'] = len(body)
+        event['retries'] = getattr(result, 'retries', 0)
+    return body.decode(charset)
+
+
+def parallel_map(func, items, workers=1):
+    """
+    Apply func to every element of items using a bounded pool of worker
+    threads and return the results in the same order as items. The first
+    exception raised by a worker is re-raised in the calling thread.
 
+    >>> parallel_map(lambda x: x * 2, [3, 1, 2], workers=2)
+    [6, 2, 4]
+    >>> parallel_map(lambda x: x, [], workers=4)
+    []
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    tasks = Queue()
+    for task in enumerate(items):
+        tasks.put(task)
+
+    def worker():
+        while not errors:
+            try:
+                (i, item) = tasks.get_nowait()
+            except Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception:
+                errors.append(sys.exc_info()[1])
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join with a timeout so that CTRL-C still reaches the main thread
+        while thread.is_alive():
+            thread.join(0.5)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def get_unit_pages(links, headers, workers=1):
+    """
+    Fetch the unit pages at the given links concurrently (sharing the
+    logged-in cookie jar) and return their contents in the order of links.
+    """
+    def fetch(link):
+        logging.info("[info] Processing '%s'..." % link)
+        return get_page_contents(link, headers, 'unit')
+    return parallel_map(fetch, links, workers)
 
-def edx_json2srt(o):
-    i = 1
-    output = ''
+
+def extract_unit_videos(page):
+    """
+    Find the videos of a unit page. Returns a list of records with the
+    YouTube video_id and the transcript_url (None if not available) of every
+    video block, followed by the videos embedded with an iframe.
+
+    The page is scanned once for the streams, transcripts and embeds, and a
+    transcript belongs to the video block whose stream precedes it. The
+    streams are searched within their attribute, so several blocks on one
+    line (as in the HTML escaped sequence contents) are all found.
+
+    >>> page = ('<div data-streams="0.75:aaaaaaaaaaa,1.0:bbbbbbbbbbb" '
+    ...         'data-transcript-translation-url="/t/translation">'
+    ...         '<iframe src="//www.youtube.com/embed/ccccccccccc?rel=0">')
+    >>> for record in extract_unit_videos(page):
+    ...     bprint('%(video_id)s %(transcript_url)s' % record)
+    bbbbbbbbbbb /t/translation
+    ccccccccccc None
+    >>> page = ('<div data-streams=&#34;1.0:dddddddd-_1,1.5:eeeeeeeeeee&#34; '
+    ...         'data-transcript-translation-url=&#34;/t/d&#34;></div>'
+    ...         '<div data-streams=&#34;0.75:fffffffffff,1.00:ggggggggggg&#34;></div>'
+    ...         '<div data-streams=&#34;1.0:hhhhhhhhhhh&#34; '
+    ...         'data-transcript-translation-url=&#34;/t/h&#34;></div>')
+    >>> for record in extract_unit_videos(page):
+    ...     bprint('%(video_id)s %(transcript_url)s' % record)
+    dddddddd-_1 /t/d
+    ggggggggggg None
+    hhhhhhhhhhh /t/h
+    >>> extract_unit_videos('<div data-streams="" '
+    ...                     'data-transcript-translation-url="/t/x"></div>')
+    []
+    >>> extract_unit_videos('<p>no videos here</p>')
+    []
+    """
+    records = []
+    embeds = []
+    block = None
+    for match in UNIT_VIDEO_RE.finditer(page):
+        if match.group('block') is not None:
+            # a block without a 1.0 stream keeps its transcript to itself
+            block = None
+            if match.group('stream') is not None:
+                block = {'video_id': match.group('stream'), 'transcript_url': None}
+                records.append(block)
+        elif match.group('transcript') is not None:
+            if block is not None and block['transcript_url'] is None:
+                block['transcript_url'] = match.group('transcript')
+        else:
+            embeds.append({'video_id': match.group('embed'), 'transcript_url': None})
+    return records + embeds
+
+
+def subtitle_timestamp(ms, separator=','):
+    """
+    Formats a time in milliseconds as a subtitle timestamp.
+
+    >>> bprint(subtitle_timestamp(3723004))
+    01:02:03,004
+    >>> bprint(subtitle_timestamp(90000000.7, '.'))
+    25:00:00.000
+    """
+    ms = int(ms)
+    (seconds, ms) = divmod(ms, 1000)
+    (minutes, seconds) = divmod(seconds, 60)
+    (hours, minutes) = divmod(minutes, 60)
+    return '%02d:%02d:%02d%s%03d' % (hours, minutes, seconds, separator, ms)
+
+
+def write_subtitles(o, f, subtitle_format='srt'):
+    """
+    Writes the cues of the edX transcript o to the text file f, one cue at
+    a time, as SubRip (srt) or WebVTT (vtt) and returns the number of cues.
+
+    >>> out = io.StringIO()
+    >>> write_subtitles({'start': [0, 1500], 'end': [1500, 3000],
+    ...                  'text': ['Hello', 'world']}, out, 'vtt')
+    2
+    >>> bprint(out.getvalue())
+    WEBVTT
+    <BLANKLINE>
+    00:00:00.000 --> 00:00:01.500
+    Hello
+    <BLANKLINE>
+    00:00:01.500 --> 00:00:03.000
+    world
+    """
+    vtt = subtitle_format == 'vtt'
+    separator = '.' if vtt else ','
+    if vtt:
+        f.write('WEBVTT\n\n')
+    i = 0
     for (s, e, t) in zip(o['start'], o['end'], o['text']):
         if t == "":
             continue
-        output += str(i) + '\n'
-        s = datetime(1, 1, 1) + timedelta(seconds=s/1000.)
-        e = datetime(1, 1, 1) + timedelta(seconds=e/1000.)
-        output += "%02d:%02d:%02d,%03d --> %02d:%02d:%02d,%03d" % \
-            (s.hour, s.minute, s.second, s.microsecond/1000,
-             e.hour, e.minute, e.second, e.microsecond/1000) + '\n'
-        output += t + "\n\n"
         i += 1
-    return output
+        if not vtt:
+            f.write('%d\n' % i)
+        f.write('%s --> %s\n%s\n\n' % (subtitle_timestamp(s, separator),
+                                        subtitle_timestamp(e, separator), t))
+    return i
+
+
+def edx_json2srt(o):
+    """
+    Returns the edX transcript o as an SRT string.
+
+    >>> bprint(edx_json2srt({'start': [0, 61000], 'end': [1000, 3661500],
+    ...                      'text': ['Hi', '']}))
+    1
+    00:00:00,000 --> 00:00:01,000
+    Hi
+    """
+    output = io.StringIO()
+    write_subtitles(o, output)
+    return output.getvalue()
 
 
 def edx_get_subtitle(url, headers):
-    """ returns a string with the subtitles content from the url """
+    """ returns the decoded edX transcript json from the url """
     """ or None if no subtitles are available """
     try:
-        jsonString = get_page_contents(url, headers)
-        jsonObject = json.loads(jsonString)
-        return edx_json2srt(jsonObject)
+        jsonString = get_page_contents(url, headers, 'subtitle')
+        return json.loads(jsonString)
     except URLError as e:
         logging.warning('[warning] edX subtitles (error:%s)' % e.reason)
         return None
 
 
+def subtitle_url(url, lang):
+    """
+    Returns the transcript url of an edX video for the given language.
+
+    >>> bprint(subtitle_url('/t/translation?videoId=abc&language=en', 'es'))
+    /t/translation?videoId=abc&language=es
+    >>> bprint(subtitle_url('/t/translation?videoId=abc', 'en'))
+    /t/translation?videoId=abc&language=en
+    """
+    return re.sub(r'&language=[^&]*', '', url) + '&language=' + lang
+
+
+def subtitle_paths(video_filename, langs, subtitle_format='srt'):
+    """
+    Returns (language, path) for the subtitles of the video in each of the
+    languages: name.srt for a single language, else name.<language>.srt
+    (or .vtt for WebVTT subtitles).
+
+    >>> [bprint(path) for (lang, path) in subtitle_paths('w/01-a.mp4', ['en'])]
+    w/01-a.srt
+    [None]
+    >>> [bprint(path) for (lang, path) in subtitle_paths('w/01-a.mp4', ['en', 'es'], 'vtt')]
+    w/01-a.en.vtt
+    w/01-a.es.vtt
+    [None, None]
+    """
+    base = os.path.splitext(video_filename)[0]
+    if len(langs) == 1:
+        return [(langs[0], '%s.%s' % (base, subtitle_format))]
+    return [(lang, '%s.%s.%s' % (base, lang, subtitle_format)) for lang in langs]
+
+
+def subtitle_tasks(jobs, args):
+    """
+    Returns (url, path, job) for every edX subtitle file of the videos of
+    jobs still to fetch in the languages of args.subtitle_langs. Subtitles
+    of a video found under another numeric prefix are renamed along with
+    it and damaged subtitle files are removed.
+    """
+    tasks = []
+    for job in jobs:
+        if not job['subs_url']:
+            continue
+        manifest = job['manifest']
+        dir_index = job['dir_index']
+        old_paths = dict(subtitle_paths(job['old_filename'], args.subtitle_langs,
+                                        args.subtitle_format)
+                         if job['old_filename'] else [])
+        for (lang, subs_filename) in subtitle_paths(job['filename'], args.subtitle_langs,
+                                                    args.subtitle_format):
+            if lang in old_paths and old_paths[lang] in dir_index:
+                logging.info("[info] Rename subs to:" + subs_filename)
+                dir_index.rename(old_paths[lang], subs_filename)
+                manifest.rename_subtitle(old_paths[lang], subs_filename)
+            if subs_filename in dir_index:
+                if manifest.subtitle_intact(subs_filename, args.verify):
+                    continue
+                logging.warning('[warning] Damaged subtitles, fetching again: %s'
+                                % subs_filename)
+                os.remove(subs_filename)
+            tasks.append((subtitle_url(job['subs_url'], lang), subs_filename, job))
+    return tasks
+
+
+def write_subtitle_file(transcript, subs_filename, job, args):
+    """
+    Writes the edX transcript as the subtitle file subs_filename of job,
+    under a temporary name renamed once complete, and records it in the
+    course manifest, so an interrupted run never leaves a partial subtitle
+    file behind.
+    """
+    target_dir = os.path.dirname(subs_filename)
+    try:
+        os.makedirs(target_dir)
+    except OSError:
+        # already there, maybe created by youtube-dl meanwhile
+        pass
+    logging.info('Writing edX subtitles: %s' % subs_filename)
+    with atomic_open(subs_filename, 'w', encoding='utf-8', newline='') as f:
+        write_subtitles(transcript, f, args.subtitle_format)
+    job['dir_index'].add(subs_filename)
+    job['manifest'].record_subtitle(subs_filename)
+
+
+def download_subtitles(jobs, args, headers):
+    """
+    Fetch, convert and write the edX subtitles of the videos of jobs in
+    every language of args.subtitle_langs, running up to args.fetch_workers
+    requests at the same time over the shared session. It does not wait
+    for the videos: subtitles are named after the filename resolved when
+    the job was prepared.
+    """
+    def fetch(task):
+        (url, subs_filename, job) = task
+        transcript = edx_get_subtitle(url, headers)
+        if transcript:
+            write_subtitle_file(transcript, subs_filename, job, args)
+
+    parallel_map(fetch, subtitle_tasks(jobs, args), args.fetch_workers)
+
+
+def default_html_parser():
+    """ returns lxml if it is installed, else the pure python html.parser """
+    try:
+        import lxml
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+
 def parse_args():
     """
     Parse the arguments/options passed to the program on the command line.
@@ -271,6 +1837,19 @@ def parse_args():
                         action='store_true',
                         default=False,
                         help='download subtitles with the videos')
+    parser.add_argument('--subtitle-lang',
+                        action='store',
+                        dest='subtitle_langs',
+                        type=lambda langs: [lang.strip() for lang in langs.split(',') if lang.strip()],
+                        default=['en'],
+                        help='comma separated languages of the edX subtitles (default: en)')
+    parser.add_argument('--subtitle-format',
+                        action='store',
+                        dest='subtitle_format',
+                        choices=['srt', 'vtt'],
+                        default='srt',
+                        help='write the edX subtitles as SubRip (srt) or WebVTT (vtt) files '
+                        '(default: srt)')
     parser.add_argument('-o',
                         '--output-dir',
                         action='store',
@@ -287,7 +1866,14 @@ def parse_args():
                         '--rate-limit',
                         action='store',
                         dest='ratelimit',
-                        help='Limit the download speed to the specified maximum L (e.g., 50k or 44.6m)',
+                        type=parse_bandwidth_schedule,
+                        help='Limit the total download speed of the videos to the '
+                        'specified maximum L (e.g., 50k or 44.6m), or to the rates of a '
+                        'time of day schedule (e.g., 09:00-18:00=500k,0 for 500k during '
+                        'business hours and no limit otherwise). Each download gets a '
+                        'share of it, which follows the budget freed by slower or '
+                        'finished downloads and the schedule (a youtube-dl process is '
+                        'restarted with --continue at its new share)',
                         default=None)
     parser.add_argument('-w',
                         '--week',
@@ -322,21 +1908,573 @@ def parse_args():
                         default=False,
                         dest='notrename',
                         help='Do not try to search and rename files with changed index')
+    parser.add_argument('--course-workers',
+                        action='store',
+                        dest='course_workers',
+                        type=int,
+                        default=4,
+                        help='Number of courses to crawl at the same time (default: 4)')
+    parser.add_argument('--fetch-workers',
+                        action='store',
+                        dest='fetch_workers',
+                        type=int,
+                        default=4,
+                        help='Number of unit pages to fetch concurrently (default: 4)')
+    parser.add_argument('-j',
+                        '--jobs',
+                        action='store',
+                        dest='jobs',
+                        type=int,
+                        default=1,
+                        help='Number of videos to download at the same time (default: 1)')
+    parser.add_argument('--job-retries',
+                        action='store',
+                        dest='job_retries',
+                        type=int,
+                        default=2,
+                        help='Times to retry a failed video download (default: 2)')
+    parser.add_argument('--engine',
+                        action='store',
+                        dest='engine',
+                        choices=['sync', 'async'],
+                        default='sync',
+                        help='crawl with blocking requests in threads (sync) or with asyncio '
+                        'coroutines on one event loop (async, python 3.7+, downloads with '
+                        'youtube-dl subprocesses) (default: sync)')
+    parser.add_argument('--async-connections',
+                        action='store',
+                        dest='async_connections',
+                        type=int,
+                        default=64,
+                        help='maximum requests in flight with --engine async (default: 64)')
+    parser.add_argument('--download-engine',
+                        action='store',
+                        dest='download_engine',
+                        choices=['subprocess', 'inprocess'],
+                        default='subprocess',
+                        help='Run every download in its own youtube-dl process '
+                        '(default) or in this process, reusing the video info '
+                        'resolved while looking up the filename (--engine sync only)')
+    parser.add_argument('--dedup',
+                        action='store',
+                        dest='dedup',
+                        choices=['auto', 'reflink', 'hardlink', 'copy', 'off'],
+                        default='auto',
+                        help='Download a video found in several units or courses '
+                        'once and make the other occurrences reflinks, hard links '
+                        'or copies of it (default: auto, the first the file system '
+                        'supports, in that order)')
+    parser.add_argument('--metadata-ttl',
+                        action='store',
+                        dest='metadata_ttl',
+                        type=float,
+                        default=168,
+                        help='Hours to reuse the cached video info of youtube-dl, '
+                        '0 disables the cache (default: 168)')
+    parser.add_argument('--metadata-cache-size',
+                        action='store',
+                        dest='metadata_cache_size',
+                        type=int,
+                        default=10000,
+                        help='Maximum number of videos kept in the info cache (default: 10000)')
+    parser.add_argument('--sync',
+                        action='store_true',
+                        default=False,
+                        dest='sync',
+                        help='Only download the videos that are not recorded as '
+                        'complete by a previous run, and only parse the units whose '
+                        'page changed since')
+    parser.add_argument('--plan-out',
+                        action='store',
+                        dest='plan_out',
+                        default=None,
+                        help='only crawl the selected courses and write the resolved '
+                        'videos (course, week, prefix, video id, format, subtitle url '
+                        'and target path) to the given JSON lines file')
+    parser.add_argument('--plan-in',
+                        action='store',
+                        dest='plan_in',
+                        default=None,
+                        help='download the videos of a plan written by --plan-out, '
+                        'without logging in or crawling')
+    parser.add_argument('--queue',
+                        action='store',
+                        dest='queue',
+                        default=None,
+                        help='add the crawled videos (or those of --plan-in) to the given '
+                        'SQLite job queue for --worker processes instead of downloading them')
+    parser.add_argument('--worker',
+                        action='store',
+                        dest='worker',
+                        default=None,
+                        help='download the videos of the given job queue, without logging '
+                        'in or crawling, until none is left; several workers may share it')
+    parser.add_argument('--worker-lease',
+                        action='store',
+                        dest='worker_lease',
+                        type=int,
+                        default=120,
+                        help='seconds after which the job of a worker that stopped '
+                        'renewing it is handed to another worker (default: 120)')
+    parser.add_argument('--trace',
+                        action='store',
+                        dest='trace',
+                        default=None,
+                        help='write the timing of every login request, page fetch, video '
+                        'resolution, download and subtitle fetch to the given JSON file '
+                        'and print a per stage summary at the end')
+    parser.add_argument('--verify',
+                        action='store_true',
+                        dest='verify',
+                        default=False,
+                        help='Also check the SHA-1 of the files recorded in the course '
+                        'manifest, not only their size, and download damaged files again')
+    parser.add_argument('--request-rate',
+                        action='store',
+                        dest='request_rate',
+                        type=float,
+                        default=0,
+                        help='maximum requests per second to the OpenEdX site. The rate '
+                        'starts at %d, grows while the site answers and drops when it '
+                        'throttles (default: 0, no maximum)' % INITIAL_REQUEST_RATE)
+    parser.add_argument('--request-retries',
+                        action='store',
+                        dest='request_retries',
+                        type=int,
+                        default=4,
+                        help='times a request to the OpenEdX site is retried when it fails '
+                        'or is throttled (default: 4)')
+    parser.add_argument('--edx-rate-limit',
+                        action='store',
+                        dest='edx_ratelimit',
+                        type=parse_bandwidth_schedule,
+                        default=None,
+                        help='Limit the bandwidth of the OpenEdX pages and transcripts, '
+                        'in the format of --rate-limit (default: no limit)')
+    parser.add_argument('--page-cache-size',
+                        action='store',
+                        dest='page_cache_size',
+                        type=float,
+                        default=100,
+                        help='Megabytes of site pages to keep for conditional '
+                        'requests and --offline, 0 disables the cache (default: 100)')
+    parser.add_argument('--session-file',
+                        action='store',
+                        dest='session_file',
+                        default=os.path.join(os.path.expanduser('~'), SESSION_FILENAME),
+                        help='File where the logged-in session is kept for the next '
+                        'runs, which skip the login while the site accepts it, an '
+                        'empty FILE disables it (default: ~/%s)' % SESSION_FILENAME,
+                        metavar='FILE')
+    parser.add_argument('--offline',
+                        action='store_true',
+                        default=False,
+                        dest='offline',
+                        help='Replay the site pages from the page cache without '
+                        'logging in or downloading anything')
+    parser.add_argument('--parser',
+                        action='store',
+                        dest='parser',
+                        choices=['lxml', 'html.parser', 'html5lib'],
+                        default=default_html_parser(),
+                        help='HTML parser used for the dashboard and courseware '
+                        '(default: lxml if installed, else html.parser)')
     parser.add_argument('--test',
                         action='store_true',
                         default=False,
                         help=argparse.SUPPRESS)
+    parser.add_argument('--benchmark',
+                        action='store',
+                        choices=sorted(BENCHMARKS),
+                        default=None,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--benchmark-size',
+                        action='store',
+                        dest='benchmark_size',
+                        type=lambda size: [int(n) for n in size.split(',')],
+                        default=[2, 4, 5, 2],
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--benchmark-latency',
+                        action='store',
+                        dest='benchmark_latency',
+                        type=int,
+                        default=20,
+                        help=argparse.SUPPRESS)
 
     args = parser.parse_args()
     return args
 
 
+def make_soup(markup, parser, *strainer):
+    """
+    Parses markup with BeautifulSoup, keeping only the tags matched by the
+    SoupStrainer arguments in strainer (everything if there are none).
+    """
+    from bs4 import BeautifulSoup
+    from bs4 import SoupStrainer
+    parse_only = SoupStrainer(*strainer) if strainer else None
+    return BeautifulSoup(markup, parser, parse_only=parse_only)
+
+
+def parse_dashboard(soup):
+    """
+    Returns (username, courses) from the soup of the dashboard, with
+    (name, url, state) for every course, where state is 'Started' or
+    'Not yet'.
+    """
+    data = soup.find_all('ul')[1]
+    username = data.find_all('span')[1].string
+    courses = []
+    for COURSE in soup.find_all('article', 'course'):
+        c_name = COURSE.h3.text.strip()
+        c_link = BASE_URL + COURSE.a['href']
+        if c_link.endswith('info') or c_link.endswith('info/'):
+            state = 'Started'
+        else:
+            state = 'Not yet'
+        courses.append((c_name, c_link, state))
+    return (username, courses)
+
+
+def parse_courseware(soup):
+    """
+    Returns (name, unit links) for every week in the soup of the
+    courseware of a course.
+    """
+    data = soup.find(*COURSEWARE_SEL)
+    WEEKS = data.find_all('div')
+    return [(w.h3.a.string, [BASE_URL + a['href'] for a in
+            w.ul.find_all('a')]) for w in WEEKS]
+
+
+def week_videos(links, pages, manifest):
+    """
+    Returns (video ids, subtitle urls) of the units at links of a week,
+    from their page in pages or, for units whose page did not change since
+    a previous run, from the course manifest, where the videos of the
+    other pages are recorded along with a checksum of the page.
+    """
+    video_id = []
+    subsUrls = []
+    for link in links:
+        digest = hashlib.sha1(pages[link].encode('utf-8')).hexdigest()
+        unit = manifest.units.get(link)
+        if unit is not None and unit.get('sha1') == digest:
+            video_id += unit['video_ids']
+            subsUrls += unit['subs_urls']
+            continue
+        unit_start = len(video_id)
+        for record in extract_unit_videos(pages[link]):
+            video_id.append(record['video_id'])
+            if record['transcript_url'] is None:
+                subsUrls.append('')
+            else:
+                subsUrls.append(BASE_URL + record['transcript_url'] + "?videoId="
+                                + record['video_id'] + "&language=en")
+        manifest.record_unit(link, video_id[unit_start:], subsUrls[unit_start:],
+                             digest)
+    return (video_id, subsUrls)
+
+
+def crawl_course(current_course, courses, args, headers, is_interactive,
+                 metadata_cache, scheduler, plan=None):
+    """
+    Crawl the weeks of the course number current_course chosen by the
+    user and submit a download job for every video found to scheduler,
+    or only add the resolved videos to plan (a PlanWriter or JobQueue) if
+    one is given.
+    """
+    if current_course <= len(courses):
+        logging.info("[info] Using course " + str(current_course) + ": " + courses[current_course - 1][0])
+    else:
+        return
+
+    if courses[current_course - 1][2] != 'Started':
+        logging.info("[info] Course " + str(current_course) + ": " + courses[current_course - 1][0] + " is not started yet")
+        return
+    selected_course = courses[current_course - 1]
+    COURSEWARE = selected_course[1].replace('info', 'courseware')
+
+    ## Getting Available Weeks
+    courseware = get_page_contents(COURSEWARE, headers, 'courseware')
+    soup = make_soup(courseware, args.parser, *COURSEWARE_SEL)
+
+    weeks = parse_courseware(soup)
+    numOfWeeks = len(weeks)
+
+    # Choose Week or choose all
+    logging.info('%s has %d weeks so far' % (selected_course[0], numOfWeeks))
+    w = 0
+    for week in weeks:
+        w += 1
+        logging.info('%d - Download %s videos' % (w, week[0].strip()))
+    if is_interactive:
+        logging.info('%d - Download them all' % (numOfWeeks + 1))
+    else:
+        logging.info('"all" - Download them all')
+    if args.list_weeks:
+        sys.exit(1)
+    if args.week:
+        if type(args.week) is list:
+            if args.week == [0]:
+                week_loop = range(1,numOfWeeks+1)
+                logging.info("[info] Downloading all items")
+            else:
+                week_loop = args.week
+                logging.info("[info] Downloading items : " + str(week_loop))
+        else:
+            logging.error('-w need number, list or "all"')
+            sys.exit(2)
+    else:
+        w_number = int(input('Enter Your Choice: '))
+        week_loop = [w_number]
+    ## TODO: check all list
+    if not week_loop:
+        while w_number > numOfWeeks + 1:
+            logging.error('Enter a valid Number between 1 and %d' % (numOfWeeks + 1))
+            w_number = int(input('Enter Your Choice: '))
+
+    ## get format / subtitles info before main loop
+    if is_interactive:
+        # Get Available Video formats
+        os.system('youtube-dl -F %s' % video_link[-1])
+        logging.error('Choose a valid format or a set of valid format codes e.g. 22/17/...')
+        args.format = input('Choose Format code: ')
+
+        args.subtitles = input('Download subtitles (y/n)? ').lower() == 'y'
+
+    logging.info("[info] Base output directory: " + args.output_dir)
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    course_folder = validate_filename(selected_course[0], "course_folder")
+    course_dir = os.path.join(args.output_dir, course_folder)
+    manifest = CourseManifest(os.path.join(course_dir, MANIFEST_FILENAME))
+
+    ## Fetch the unit pages of every selected week at once (through the
+    ## page cache, an unchanged page is only revalidated)
+    week_links = [link for current_week in week_loop
+                  for link in weeks[current_week - 1][1]]
+    pages = dict(zip(week_links, get_unit_pages(week_links, headers,
+                                                args.fetch_workers)))
+
+    subtitle_langs = args.subtitle_langs if args.subtitles else []
+
+    ## Week loop
+    for current_week in week_loop:
+        links = weeks[current_week - 1][1]
+        w_name = weeks[current_week-1][0].strip()
+        logging.info("[info] Processing item # %s  " % current_week)
+        (video_id, subsUrls) = week_videos(links, pages, manifest)
+
+        video_link = ['http://youtube.com/watch?v=' + v_id
+                      for v_id in video_id]
+
+        if len(video_link) < 1:
+            logging.warning('WARNING: No downloadable video found.')
+            continue
+            # sys.exit(0)
+
+        # Resolve the videos of this week
+        week_jobs = []
+        w_folder = validate_filename(w_name,"week " + str(current_week))
+        target_dir = os.path.join(course_dir, w_folder)
+        dir_index = DirectoryIndex(target_dir) if plan is None else None
+        c = 0
+        for v_id, v, s in zip(video_id, video_link, subsUrls):
+            c += 1
+            filename_prefix = str(c).zfill(2)
+            manifest_key = w_folder + '/' + filename_prefix
+            if args.offline:
+                logging.info("[info] Offline, not downloading %s to %s" % (v, target_dir))
+                continue
+            if args.sync and manifest.is_complete(manifest_key, v_id, s, subtitle_langs,
+                                                  args.subtitle_format, args.verify):
+                logging.info("[info] Already downloaded: %s %s" % (manifest_key, v_id))
+                continue
+            video_format = args.format + '/mp4' if args.format else None
+            (video_filename, video_info) = resolve_video(v_id, str(v), video_format,
+                                                         args.subtitles, metadata_cache)
+            item = plan_item(selected_course[0], current_course, course_folder,
+                             current_week, w_folder, filename_prefix, v_id, s,
+                             video_format, video_filename, args.subtitles)
+            if plan is not None:
+                plan.add(item)
+                continue
+            job = prepare_job(item, args, manifest, dir_index)
+            # only the in-process engine reuses the resolved info
+            if args.download_engine == 'inprocess':
+                job['info'] = video_info
+            week_jobs.append(job)
+            scheduler.submit(current_course, job)
+
+        # Subtitles are fetched while the videos of the week download
+        if args.subtitles and week_jobs:
+            download_subtitles(week_jobs, args, headers)
+        ## /week loop
+    manifest.save()
+
+
+def plan_item(course, course_number, course_folder, week, week_folder, prefix,
+              video_id, subs_url, video_format, video_filename, subtitles):
+    """
+    Returns the plan item of a resolved video: everything needed to
+    download it (see prepare_job) without crawling again, in the format
+    and with the subtitles it was resolved for.
+    """
+    return {
+        'course': course,
+        'course_number': course_number,
+        'course_folder': course_folder,
+        'week': week,
+        'week_folder': week_folder,
+        'prefix': prefix,
+        'video_id': video_id,
+        'url': 'http://youtube.com/watch?v=' + video_id,
+        'format': video_format,
+        'subtitles': subtitles,
+        'subs_url': subs_url,
+        'path': '/'.join([course_folder, week_folder, prefix + '-' + video_filename]),
+    }
+
+
+def prepare_job(item, args, manifest, dir_index):
+    """
+    Turns a resolved video (a plan item) into a download job under
+    args.output_dir. A copy of the video saved under another numeric prefix
+    is renamed to the expected one and a damaged earlier download is moved
+    out of the way first.
+    """
+    target_dir = dir_index.path
+    filename_prefix = item['prefix']
+    video_filename = item['path'].split('/')[-1].split('-', 1)[1]
+    manifest_key = item['week_folder'] + '/' + filename_prefix
+    cmd = ["youtube-dl", "--newline", "--continue",
+           "-o", os.path.join(target_dir, filename_prefix + "-%(title)s.%(ext)s")]
+    if item['format']:
+        # the format falls back to mp4 in case the requested one isn't available
+        cmd += ["-f", item['format']]
+    if item['subtitles']:
+        cmd.append('--write-sub')
+    cmd.append(item['url'])
+
+    file_renamed = False
+    v_fn_exact = os.path.join(target_dir, filename_prefix + "-" + video_filename)
+    found = dir_index.find(video_filename, len(filename_prefix))
+
+    if (len(found) == 1) and (filename_prefix not in found):
+        old_filename = list(found.values())[0]
+        logging.info("[info] Found with different index:" + old_filename)
+        file_renamed = True
+        if not args.notrename:
+            logging.info("[info] Rename to:" + v_fn_exact)
+            dir_index.rename(old_filename, v_fn_exact)
+        else:
+            logging.info("[info] No action")
+
+    damage = manifest.video_damage(manifest_key, item['video_id'], args.verify)
+    if damage and not file_renamed:
+        discard_damaged_video(manifest.video_path(manifest_key), damage)
+
+    return {
+        'tag': '[c%d w%d %s]' % (item['course_number'], item['week'], filename_prefix),
+        'url': item['url'],
+        'cmd': cmd,
+        'outtmpl': cmd[cmd.index('-o') + 1],
+        'format': item['format'],
+        'subtitles': item['subtitles'],
+        'info': None,
+        'subs_url': item['subs_url'],
+        'target_dir': target_dir,
+        'prefix': filename_prefix,
+        'old_filename': old_filename if file_renamed else None,
+        'filename': v_fn_exact,
+        'video_id': item['video_id'],
+        'manifest': manifest,
+        'manifest_key': manifest_key,
+        'dir_index': dir_index,
+    }
+
+
+class PlanWriter(object):
+    """
+    Collects the resolved videos of a --plan-out crawl and writes them to
+    path as JSON lines, ordered by course, week and prefix, once the crawl
+    is done.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.items = []
+        self._lock = threading.Lock()
+
+    def add(self, item):
+        with self._lock:
+            self.items.append(item)
+
+    def close(self):
+        self.items.sort(key=lambda item: (item['course_number'], item['week'],
+                                          item['prefix']))
+        with atomic_open(self.path, 'w', encoding='utf-8') as f:
+            for item in self.items:
+                f.write(json.dumps(item, sort_keys=True) + '\n')
+        logging.info('[info] Wrote %d videos to the plan %s'
+                     % (len(self.items), self.path))
+
+
+def read_plan(path):
+    """ returns the items of the plan written by --plan-out to path """
+    with io.open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def run_plan(args, headers, scheduler):
+    """
+    Submit the videos of the plan saved by --plan-out in args.plan_in to
+    scheduler, week folder by week folder, without logging in or crawling,
+    then fetch their subtitles.
+    """
+    items = read_plan(args.plan_in)
+    logging.info('[info] %d videos in the plan %s' % (len(items), args.plan_in))
+    manifests = {}
+    weeks = collections.OrderedDict()
+    for item in items:
+        weeks.setdefault((item['course_folder'], item['week_folder']), []).append(item)
+    for ((course_folder, week_folder), week_items) in weeks.items():
+        course_dir = os.path.join(args.output_dir, course_folder)
+        if course_folder not in manifests:
+            manifests[course_folder] = CourseManifest(os.path.join(course_dir,
+                                                                   MANIFEST_FILENAME))
+        manifest = manifests[course_folder]
+        dir_index = DirectoryIndex(os.path.join(course_dir, week_folder))
+        week_jobs = []
+        for item in week_items:
+            manifest_key = week_folder + '/' + item['prefix']
+            subtitle_langs = args.subtitle_langs if item['subtitles'] else []
+            if args.sync and manifest.is_complete(manifest_key, item['video_id'],
+                                                  item['subs_url'], subtitle_langs,
+                                                  args.subtitle_format, args.verify):
+                logging.info("[info] Already downloaded: %s %s"
+                             % (manifest_key, item['video_id']))
+                continue
+            job = prepare_job(item, args, manifest, dir_index)
+            week_jobs.append(job)
+            scheduler.submit(item['course_number'], job)
+        subtitle_jobs = [job for job in week_jobs if job['subtitles']]
+        if subtitle_jobs:
+            download_subtitles(subtitle_jobs, args, headers)
+    for manifest in manifests.values():
+        manifest.save()
+
+
 def main():
     args = parse_args()
     if args.test:
         import doctest
         doctest.testmod(verbose=True)
         sys.exit(0)
+    if args.benchmark:
+        BENCHMARKS[args.benchmark](args)
+        sys.exit(0)
     ## clean args a bit. Maybe argparse can do it for me
     ## TODO: add exception handling
     ## TODO: clean args processing
@@ -352,7 +2490,38 @@ def main():
 
     change_openedx_site(args.platform)
 
-    if not args.username or not args.password:
+    if args.engine == 'async' and not (args.plan_in or args.worker):
+        if sys.version_info < (3, 7):
+            logging.error("[error] --engine async needs python 3.7 or later")
+            sys.exit(2)
+        if is_interactive or not args.week or not (args.course_number or args.course_id):
+            if not (args.list_enrolled or args.list_weeks):
+                logging.error("[error] --engine async needs the courses (-c or --course-id) "
+                              "and the weeks (-w)")
+                sys.exit(2)
+        if not args.offline and (not args.username or not args.password):
+            logging.error("[error] You must supply username AND password to log-in")
+            sys.exit(2)
+        import edx_dl_async
+        edx_dl_async.run(sys.modules[__name__], args)
+        report_trace(args)
+        return
+
+    session = get_session()
+    if args.page_cache_size > 0:
+        session.page_cache = PageCache(os.path.join(args.output_dir, CACHE_FILENAME),
+                                       args.page_cache_size * 1024 * 1024)
+    elif args.offline:
+        logging.error("[error] --offline needs the page cache")
+        sys.exit(2)
+    session.offline = args.offline
+    session.governor = RequestGovernor(args.request_rate)
+    if args.edx_ratelimit:
+        session.bandwidth = BandwidthController(args.edx_ratelimit)
+    session.retries = args.request_retries
+
+    skip_login = args.offline or args.plan_in or args.worker
+    if not skip_login and (not args.username or not args.password):
         logging.error("[error] You must supply username AND password to log-in")
         sys.exit(2)
 
@@ -363,37 +2532,64 @@ def main():
         'Content-Type': 'application/x-www-form-urlencoded;charset=utf-8',
         'Referer': EDX_HOMEPAGE,
         'X-Requested-With': 'XMLHttpRequest',
-        'X-CSRFToken': get_initial_token(),
+        'X-CSRFToken': '',
     }
-
-    # Login
-    post_data = urlencode({'email': args.username, 'password': args.password,
-                           'remember': False}).encode('utf-8')
-    request = Request(LOGIN_API, post_data, headers)
-    response = urlopen(request)
-    resp = json.loads(response.read().decode('utf-8'))
-    if not resp.get('success', False):
-        logging.error(resp.get('value', "Wrong Email or Password."))
-        exit(2)
+    session.headers.update(headers)
+
+    if (args.worker or args.plan_in and not args.queue) and not args.offline:
+        # the transcripts are fetched with the session saved by a normal run,
+        # a plan or a worker never logs in
+        if not (args.session_file and
+                resume_session(SessionStore(args.session_file), args.username, headers)):
+            logging.warning('[warning] No saved session (--session-file), the edX '
+                            'subtitles need one: log in with a normal run first')
+
+    if args.worker:
+        run_worker(args, headers)
+        report_trace(args)
+        return
+    if args.plan_in and args.queue:
+        queue = JobQueue(args.queue)
+        for item in read_plan(args.plan_in):
+            queue.add(item)
+        queue.close()
+        return
+    if args.plan_in:
+        scheduler = DownloadScheduler(args, headers)
+        run_plan(args, headers, scheduler)
+        scheduler.wait()
+        report_trace(args)
+        return
+
+    # Login, unless the session saved by a previous run is still valid
+    store = None
+    resumed = False
+    if not args.offline:
+        if args.session_file:
+            store = SessionStore(args.session_file)
+            resumed = resume_session(store, args.username, headers)
+        if not resumed:
+            login(args.username, args.password, headers)
 
     # Get user info/courses
-    dash = get_page_contents(DASHBOARD, headers)
-    soup = BeautifulSoup(dash)
-    data = soup.find_all('ul')[1]
-    USERNAME = data.find_all('span')[1].string
-    COURSES = soup.find_all('article', 'course')
-    courses = []
+    try:
+        dash = get_page_contents(DASHBOARD, headers, 'dashboard')
+    except HTTPError as e:
+        if not resumed or e.code not in (401, 403):
+            raise
+        logging.info('[info] The saved session was rejected, logging in again')
+        session.cookies.clear()
+        login(args.username, args.password, headers)
+        dash = get_page_contents(DASHBOARD, headers, 'dashboard')
+    if store is not None:
+        store.save(args.username, session.cookies, session.csrftoken)
+    # only the user info list and the course articles are needed
+    soup = make_soup(dash, args.parser, ['ul', 'article'])
+    (USERNAME, courses) = parse_dashboard(soup)
     course_loop = []
     c = 0
-    for COURSE in COURSES:
+    for (c_name, c_link, state) in courses:
         c += 1
-        c_name = COURSE.h3.text.strip()
-        c_link = BASE_URL + COURSE.a['href']
-        if c_link.endswith('info') or c_link.endswith('info/'):
-            state = 'Started'
-        else:
-            state = 'Not yet'
-        courses.append((c_name, c_link, state))
         if args.course_id and (c_link.rstrip("/") == args.course_id.rstrip("/")):
             course_loop = [c]
     numOfCourses = len(courses)
@@ -412,7 +2608,7 @@ def main():
 
     if args.course_number:
         if type(args.course_number) is list:
-            if args.course_number == ['all']:
+            if args.course_number == [0]:
                 course_loop = range(1,numOfCourses+1)
                 logging.info("[info] Downloading all started courses")
             else:
@@ -434,189 +2630,1265 @@ def main():
             c_number = int(input('Enter Course Number: '))
             course_loop = [c_number]
 
+    if args.metadata_ttl > 0:
+        metadata_cache = MetadataCache(os.path.join(args.output_dir, CACHE_FILENAME),
+                                       args.metadata_ttl * 3600, args.metadata_cache_size)
+    else:
+        metadata_cache = None
+
     ## course loop
+    scheduler = DownloadScheduler(args, headers)
+    if args.queue:
+        plan = JobQueue(args.queue)
+    elif args.plan_out:
+        plan = PlanWriter(args.plan_out)
+    else:
+        plan = None
 
-    for current_course in course_loop:
-        if current_course <= numOfCourses:
-            logging.info("[info] Using course " + str(current_course) + ": " + COURSES[current_course - 1].h3.text.strip())
-        else:
-            continue
+    # courses are crawled concurrently, unless the user has to be asked
+    if args.week and not args.list_weeks and not is_interactive:
+        course_workers = args.course_workers
+    else:
+        course_workers = 1
+    parallel_map(lambda current_course: crawl_course(current_course, courses, args, headers,
+                                                     is_interactive, metadata_cache, scheduler,
+                                                     plan),
+                 course_loop, course_workers)
+    if plan is not None:
+        plan.close()
+
+    # Download Videos
+    scheduler.wait()
+    report_trace(args)
+
+
+def report_trace(args):
+    """ writes the trace of the run to args.trace and logs its summary """
+    if not args.trace:
+        return
+    TRACE.save(args.trace)
+    logging.info('[info] Timings (trace written to %s):' % args.trace)
+    for line in TRACE.summary():
+        logging.info('[info] ' + line)
+
+def parse_rate(rate):
+    """
+    Convert a youtube-dl style rate (e.g., 50k or 44.6m) to bytes per second.
+    Returns None if the rate cannot be parsed.
+
+    >>> parse_rate('50k')
+    51200
+    >>> parse_rate('1.5M')
+    1572864
+    >>> parse_rate('300')
+    300
+    >>> parse_rate('fast') is None
+    True
+    """
+    m = re.match(r'(?i)^(\d+(?:\.\d+)?)([kmgtpezy]?)$', rate.strip())
+    if not m:
+        return None
+    multiplier = 1024 ** 'bkmgtpezy'.index((m.group(2) or 'b').lower())
+    return int(float(m.group(1)) * multiplier)
 
-        if courses[current_course - 1][2] != 'Started':
-            logging.info("[info] Course " + str(current_course) + ": " + COURSES[current_course - 1].h3.text.strip() + " is not started yet")
-            continue
-        selected_course = courses[current_course - 1]
-        COURSEWARE = selected_course[1].replace('info', 'courseware')
-
-        ## Getting Available Weeks
-        courseware = get_page_contents(COURSEWARE, headers)
-        soup = BeautifulSoup(courseware)
-
-        data = soup.find(*COURSEWARE_SEL)
-        WEEKS = data.find_all('div')
-        weeks = [(w.h3.a.string, [BASE_URL + a['href'] for a in
-                 w.ul.find_all('a')]) for w in WEEKS]
-        numOfWeeks = len(weeks)
-
-        # Choose Week or choose all
-        logging.info('%s has %d weeks so far' % (selected_course[0], numOfWeeks))
-        w = 0
-        for week in weeks:
-            w += 1
-            logging.info('%d - Download %s videos' % (w, week[0].strip()))
-        if is_interactive:
-            logging.info('%d - Download them all' % (numOfWeeks + 1))
+
+def parse_bandwidth_schedule(spec):
+    """
+    Parse a bandwidth limit: a rate (see parse_rate) or a comma separated
+    time of day schedule of HH:MM-HH:MM=RATE periods, with an optional
+    bare rate for the rest of the day (no limit if there is none). A rate
+    of 0 means no limit. Returns the (start minute, end minute, bytes per
+    second or None) periods, the rest of the day last. Raises ValueError
+    for anything else, so that argparse reports it.
+
+    >>> parse_bandwidth_schedule('50k')
+    [(0, 1440, 51200)]
+    >>> parse_bandwidth_schedule('22:00-06:00=0,09:00-18:00=500k')
+    [(1320, 360, None), (540, 1080, 512000)]
+    >>> parse_bandwidth_schedule('09:00-18:00=fast')
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid rate: fast
+    """
+    periods = []
+    rest = []
+    for part in spec.split(','):
+        m = re.match(r'^\s*(\d\d?):(\d\d)-(\d\d?):(\d\d)=(.*)$', part)
+        rate = parse_rate(m.group(5) if m else part)
+        if rate is None:
+            raise ValueError('invalid rate: ' + (m.group(5) if m else part).strip())
+        if m:
+            (start_h, start_m, end_h, end_m) = [int(n) for n in m.groups()[:4]]
+            periods.append((start_h * 60 + start_m, end_h * 60 + end_m, rate or None))
         else:
-            logging.info('"all" - Download them all')
-        if args.list_weeks:
-            sys.exit(1)
-        if args.week:
-            if type(args.week) is list:
-                if args.week == [0]:
-                    week_loop = range(1,numOfWeeks+1)
-                    logging.info("[info] Downloading all items")
+            rest = [(0, 24 * 60, rate or None)]
+    return periods + rest
+
+
+def schedule_rate(schedule, minute=None):
+    """
+    Returns the bytes per second allowed by schedule (see
+    parse_bandwidth_schedule, None means no limit) at the given minute of
+    the day, local time by default.
+
+    >>> schedule = parse_bandwidth_schedule('22:00-06:00=0,09:00-18:00=100k,1m')
+    >>> [schedule_rate(schedule, hour * 60) for hour in (23, 3, 12, 7)]
+    [None, None, 102400, 1048576]
+    >>> schedule_rate(parse_bandwidth_schedule('09:00-18:00=100k'), 20 * 60) is None
+    True
+    """
+    if minute is None:
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+    for (start, end, rate) in schedule or []:
+        if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+            return rate
+    return None
+
+
+def allocate_bandwidth(budget, speeds):
+    """
+    Share budget bytes per second among downloads going at the given
+    speeds (None if not known yet): a download slower than its fair share
+    gets its speed plus BANDWIDTH_HEADROOM to grow into, and the rest is
+    split evenly among the others, or among all of them if they are all
+    slower.
+
+    >>> allocate_bandwidth(1000, [None, None])
+    [500.0, 500.0]
+    >>> allocate_bandwidth(1000, [100, None, 600])
+    [125.0, 437.5, 437.5]
+    >>> allocate_bandwidth(1000, [100, 300])
+    [500.0, 500.0]
+    """
+    allotments = [None] * len(speeds)
+    pending = list(range(len(speeds)))
+    while pending:
+        share = float(budget) / len(pending)
+        limited = [i for i in pending if speeds[i] is not None and
+                   speeds[i] * BANDWIDTH_HEADROOM < share]
+        if len(limited) in (0, len(pending)):
+            for i in pending:
+                allotments[i] = share
+            break
+        for i in limited:
+            allotments[i] = speeds[i] * BANDWIDTH_HEADROOM
+            budget -= allotments[i]
+            pending.remove(i)
+    return allotments
+
+
+class BandwidthController(object):
+    """
+    Bandwidth budget of the whole run for one kind of traffic, following
+    the time of day schedule of parse_bandwidth_schedule. Downloads share
+    it among themselves (see start), so that the budget freed by slow or
+    finished downloads, or by the schedule, goes to the others: the rate of
+    an in-process download is revised on every block it receives (see
+    update), while a youtube-dl process, which cannot change its rate
+    limit, is restarted at its new share when it changed much (see revise).
+    Page requests spend it as a token bucket (see reserve).
+
+    >>> bandwidth = BandwidthController(parse_bandwidth_schedule('100k'), slots=2)
+    >>> bandwidth.start('a', fixed=True)
+    51200
+    >>> bandwidth.start('b', fixed=False)
+    51200
+    >>> bandwidth.finish('a')
+    >>> bandwidth.update('b', 50000.0)
+    102400
+
+    A youtube-dl process left alone may take the whole budget:
+
+    >>> bandwidth = BandwidthController(parse_bandwidth_schedule('100k'), slots=2)
+    >>> bandwidth.restart_interval = 0
+    >>> bandwidth.start('a', fixed=True)
+    51200
+    >>> bandwidth.revise('a', 50000.0)
+    102400
+    >>> bandwidth.revise('a', 100000.0)
+    False
+    """
+    def __init__(self, schedule, slots=1):
+        self.schedule = schedule
+        self.slots = max(1, slots)
+        self.restart_interval = BANDWIDTH_RESTART_INTERVAL
+        self._fixed = {}
+        self._fixed_speeds = {}
+        self._started = {}
+        self._speeds = {}
+        self._tokens = None
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def rate(self):
+        """ returns the bytes per second allowed now, None if unlimited """
+        return schedule_rate(self.schedule)
+
+    def start(self, key, fixed):
+        """
+        Registers the download key and returns its bytes per second (None
+        if unlimited). A fixed download gets an even share of the budget
+        the others leave for the free download slots.
+        """
+        with self._lock:
+            rate = self.rate()
+            if not fixed:
+                self._speeds[key] = None
+                return self._allot(key, rate)
+            if rate is not None:
+                used = sum(self._fixed.values()) + sum(
+                    self._allot(k, rate) for k in self._speeds)
+                free_slots = max(1, self.slots - len(self._fixed) - len(self._speeds))
+                if used < rate:
+                    rate = max(1, int((rate - used) / free_slots))
                 else:
-                    week_loop = args.week
-                    logging.info("[info] Downloading items : " + str(week_loop))
-            else:
-                logging.error('-w need number, list or "all"')
-                sys.exit(2)
+                    rate = max(1, rate // self.slots)
+            self._fixed[key] = rate or 0
+            self._fixed_speeds[key] = None
+            self._started[key] = time.time()
+            return rate
+
+    def revise(self, key, speed):
+        """
+        Records the speed of the fixed download key (None if not known) and
+        returns the bytes per second (None if unlimited) to restart it at,
+        or False to keep it going: it is restarted once it has run for
+        restart_interval seconds, if its share of the budget among the
+        fixed downloads (see allocate_bandwidth) changed by
+        BANDWIDTH_RESTART_CHANGE of its rate, or the limit came or went.
+        """
+        with self._lock:
+            self._fixed_speeds[key] = speed
+            now = time.time()
+            if now - self._started[key] < self.restart_interval:
+                return False
+            rate = self.rate()
+            if rate is not None:
+                # fixed and in-process downloads do not run together
+                keys = sorted(self._fixed)
+                allotments = allocate_bandwidth(rate, [self._fixed_speeds[k] for k in keys])
+                rate = max(1, int(allotments[keys.index(key)]))
+            current = self._fixed[key] or None
+            if (current is None) == (rate is None) and \
+                    (rate is None or abs(rate - current) < current * BANDWIDTH_RESTART_CHANGE):
+                return False
+            self._fixed[key] = rate or 0
+            self._fixed_speeds[key] = None
+            self._started[key] = now
+            return rate
+
+    def update(self, key, speed):
+        """ records the speed of the download key, returns its new bytes per second """
+        with self._lock:
+            self._speeds[key] = speed
+            return self._allot(key, self.rate())
+
+    def _allot(self, key, rate):
+        if rate is None:
+            return None
+        keys = sorted(self._speeds)
+        budget = max(rate - sum(self._fixed.values()), rate // self.slots)
+        allotments = allocate_bandwidth(budget, [self._speeds[k] for k in keys])
+        return max(1, int(allotments[keys.index(key)]))
+
+    def finish(self, key):
+        """ gives the bandwidth of the download key back """
+        with self._lock:
+            self._fixed.pop(key, None)
+            self._fixed_speeds.pop(key, None)
+            self._started.pop(key, None)
+            self._speeds.pop(key, None)
+
+    def reserve(self, size):
+        """
+        spends size bytes of the budget and returns the seconds to wait
+        before the next transfer, which is 0 while the budget of the last
+        second is not spent
+        """
+        with self._lock:
+            rate = self.rate()
+            now = time.time()
+            if rate is None:
+                self._tokens = None
+                return 0
+            if self._tokens is None:
+                self._tokens = float(rate)
+            self._tokens = min(float(rate), self._tokens + (now - self._updated) * rate)
+            self._updated = now
+            self._tokens -= size
+            return -self._tokens / rate if self._tokens < 0 else 0
+
+
+def job_print(tag, line):
+    """ prints a line of a job output without mixing it with other jobs """
+    with PRINT_LOCK:
+        print(('%s %s' % (tag, line.rstrip())).strip())
+        sys.stdout.flush()
+
+
+def parse_progress(line):
+    """
+    Parse a youtube-dl progress line into an event with the percent done,
+    and the total size, speed and ETA as printed by youtube-dl. Returns None
+    for any other line.
+
+    >>> event = parse_progress('[download]  45.3% of 10.00MiB at  1.23MiB/s ETA 00:05')
+    >>> event['percent']
+    45.3
+    >>> bprint(' '.join([event['size'], event['speed'], event['eta']]))
+    10.00MiB 1.23MiB/s 00:05
+    >>> parse_progress('[download] 100% of 10.00MiB in 00:03')['percent']
+    100.0
+    >>> parse_progress('[youtube] xyz: Downloading webpage') is None
+    True
+    """
+    m = PROGRESS_RE.match(line)
+    if not m:
+        return None
+    return {'percent': float(m.group('percent')), 'size': m.group('size'),
+            'speed': m.group('speed'), 'eta': m.group('eta')}
+
+
+def parse_speed(speed):
+    """
+    Convert the speed of a youtube-dl progress event to bytes per second.
+    Returns None if it is not known.
+
+    >>> parse_speed('1.50KiB/s')
+    1536
+    >>> parse_speed('Unknown speed') is None
+    True
+    """
+    m = re.match(r'^\s*(\d+(?:\.\d+)?[KMGTPEZY]?)i?B/s\s*$', speed or '')
+    return parse_rate(m.group(1)) if m else None
+
+
+class JobProgress(object):
+    """
+    Prints the progress events of a download job as a single status line,
+    at most once every PROGRESS_INTERVAL seconds and once when it is done.
+    """
+    def __init__(self, tag):
+        self.tag = tag
+        self.last = None
+        self._printed = 0
+
+    def update(self, event):
+        self.last = event
+        now = time.time()
+        if event['percent'] < 100 and now - self._printed < PROGRESS_INTERVAL:
+            return
+        self._printed = now
+        line = '[download] %5.1f%% of %s' % (event['percent'],
+                                            event['size'] or 'Unknown size')
+        if event['percent'] < 100:
+            line += ' at %s ETA %s' % (event['speed'] or 'Unknown speed',
+                                       event['eta'] or 'Unknown')
+        job_print(self.tag, line)
+
+
+def relay_output(stream, handle_line):
+    """
+    Read stream in chunks until it is closed, calling handle_line for every
+    non-empty line. Lines may end with \\r (progress updates) or \\n.
+    """
+    enc = sys.getdefaultencoding()
+    pending = b''
+    while True:
+        chunk = os.read(stream.fileno(), 65536)
+        if not chunk:
+            break
+        lines = re.split(b'[\r\n]', pending + chunk)
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                handle_line(line.decode(enc, 'replace'))
+    if pending.strip():
+        handle_line(pending.decode(enc, 'replace'))
+
+
+def run_youtube_dl(cmd, tag, on_progress=None):
+    """
+    Run youtube-dl with the given command line. Its progress output is
+    turned into progress events and the rest of its output is relayed
+    prefixed with the job tag. Both pipes are drained at the same time, so
+    a chatty youtube-dl never blocks. youtube-dl is stopped when
+    on_progress, if given, returns True for a progress event. Returns the
+    youtube-dl exit status.
+    """
+    logging.info("[info] youtube-dl: " + ' '.join(cmd))
+    popen_youtube = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    progress = JobProgress(tag)
+
+    def handle_stdout(line):
+        event = parse_progress(line)
+        if event is None:
+            job_print(tag, line)
+            return
+        progress.update(event)
+        if on_progress is not None and on_progress(event):
+            popen_youtube.terminate()
+
+    stderr_relay = threading.Thread(target=relay_output,
+                                    args=(popen_youtube.stderr,
+                                          lambda line: job_print(tag, line)))
+    stderr_relay.daemon = True
+    stderr_relay.start()
+    relay_output(popen_youtube.stdout, handle_stdout)
+    stderr_relay.join()
+    return popen_youtube.wait()
+
+
+def youtube_dl_download(job, bandwidth, reuse_info=True):
+    """
+    Download a job with the YoutubeDL instance of the current thread, at
+    the speed the BandwidthController bandwidth allows while it goes. The
+    info resolved when the job was prepared is reused unless reuse_info is
+    False (e.g., because its media URLs may have expired since). Returns
+    True if the download succeeded.
+    """
+    import youtube_dl
+    ydl = get_youtube_dl()
+    ydl.params.update({
+        'outtmpl': job['outtmpl'],
+        'format': job['format'],
+        'writesubtitles': job['subtitles'],
+        'ratelimit': bandwidth.start(id(job), fixed=False),
+        'continuedl': True,
+    })
+    ydl.params['logger'].tag = job['tag']
+    YOUTUBE_DL_LOCAL.progress = JobProgress(job['tag'])
+    YOUTUBE_DL_LOCAL.bandwidth = bandwidth
+    YOUTUBE_DL_LOCAL.key = id(job)
+    try:
+        if reuse_info and job.get('info'):
+            ydl.process_info(dict(job['info']))
         else:
-            w_number = int(input('Enter Your Choice: '))
-            week_loop = [w_number]
-        ## TODO: check all list
-        if not week_loop:
-            while w_number > numOfWeeks + 1:
-                logging.error('Enter a valid Number between 1 and %d' % (numOfWeeks + 1))
-                w_number = int(input('Enter Your Choice: '))
-
-        ## get format / subtitles info before main loop
-        if is_interactive:
-            # Get Available Video formats
-            os.system('youtube-dl -F %s' % video_link[-1])
-            logging.error('Choose a valid format or a set of valid format codes e.g. 22/17/...')
-            args.format = input('Choose Format code: ')
-
-            args.subtitles = input('Download subtitles (y/n)? ').lower() == 'y'
-
-        logging.info("[info] Base output directory: " + args.output_dir)
-        ## Week loop
-        for current_week in week_loop:
-            links = weeks[current_week - 1][1]
-            w_name = weeks[current_week-1][0].strip()
-            logging.info("[info] Processing item # %s  " % current_week)
-            video_id = []
-            subsUrls = []
-            regexpSubs = re.compile(r'data-transcript-translation-url=(?:&#34;|")([^"&]*)(?:&#34;|")')
-            splitter = re.compile(r'data-streams=(?:&#34;|").*1.0[0]*:')
-            extra_youtube = re.compile(r'//w{0,3}\.youtube.com/embed/([^ \?&]*)[\?& ]')
-            for link in links:
-                logging.info("[info] Processing '%s'..." % link)
-                page = get_page_contents(link, headers)
-
-                id_container = splitter.split(page)[1:]
-                video_id += [link[:YOUTUBE_VIDEO_ID_LENGTH] for link in
-                             id_container]
-                subsUrls += [BASE_URL + regexpSubs.search(container).group(1) + "?videoId=" + id + "&language=en"
-                             for id, container in zip(video_id[-len(id_container):], id_container)]
-                # Try to download some extra videos which is referred by iframe
-                extra_ids = extra_youtube.findall(page)
-                video_id += [link[:YOUTUBE_VIDEO_ID_LENGTH] for link in
-                             extra_ids]
-                subsUrls += ['' for link in extra_ids]
-
-            video_link = ['http://youtube.com/watch?v=' + v_id
-                          for v_id in video_id]
-
-            if len(video_link) < 1:
-                logging.warning('WARNING: No downloadable video found.')
+            ydl.extract_info(job['url'], download=True)
+    except youtube_dl.utils.DownloadError:
+        # youtube-dl already reported the error through the logger
+        return False
+    finally:
+        ydl.params['logger'].tag = ''
+        YOUTUBE_DL_LOCAL.progress = None
+        YOUTUBE_DL_LOCAL.bandwidth = None
+        bandwidth.finish(id(job))
+    return True
+
+
+def rate_limited_cmd(cmd, rate):
+    """
+    Returns the youtube-dl command cmd limited to rate bytes per second,
+    if any.
+
+    >>> bprint(' '.join(rate_limited_cmd(['youtube-dl', 'URL'], 1024)))
+    youtube-dl URL --rate-limit=1024
+    >>> bprint(' '.join(rate_limited_cmd(['youtube-dl', 'URL'], None)))
+    youtube-dl URL
+    """
+    return cmd + ['--rate-limit=%d' % rate] if rate else cmd
+
+
+class RateWatch(object):
+    """
+    Progress callback of the youtube-dl process of the download key with
+    the job tag, asking to stop it (see run_youtube_dl) once the
+    BandwidthController bandwidth has a new rate for it (see
+    BandwidthController.revise), kept in rate.
+    """
+    def __init__(self, bandwidth, key, tag):
+        self.bandwidth = bandwidth
+        self.key = key
+        self.tag = tag
+        self.restart = False
+        self.rate = None
+
+    def __call__(self, event):
+        if self.restart or event['percent'] >= 100:
+            return False
+        rate = self.bandwidth.revise(self.key, parse_speed(event['speed']))
+        if rate is False:
+            return False
+        (self.restart, self.rate) = (True, rate)
+        job_print(self.tag, '[bandwidth] restarting youtube-dl at %s'
+                  % ('%d B/s' % rate if rate else 'no limit'))
+        return True
+
+
+def run_youtube_dl_limited(cmd, tag, bandwidth, key):
+    """
+    Runs a youtube-dl command at its share of the BandwidthController
+    bandwidth. youtube-dl cannot change its rate limit, so when its share
+    changes much it is stopped and started again at the new rate, resuming
+    the partial file (--continue).
+    """
+    rate = bandwidth.start(key, fixed=True)
+    try:
+        while True:
+            watch = RateWatch(bandwidth, key, tag)
+            status = run_youtube_dl(rate_limited_cmd(cmd, rate), tag, watch)
+            if not watch.restart:
+                return status
+            rate = watch.rate
+    finally:
+        bandwidth.finish(key)
+
+
+def download_attempts(job, retries):
+    """
+    Yields, for each of the up to retries + 1 attempts at downloading job,
+    the seconds to wait before it (exponential backoff), counting them in
+    job['attempts']. The caller stops iterating once an attempt succeeds.
+    """
+    for attempt in range(retries + 1):
+        job['attempts'] = attempt + 1
+        if not attempt:
+            yield 0
+            continue
+        delay = DOWNLOAD_RETRY_BACKOFF * 2 ** (attempt - 1)
+        job_print(job['tag'], '[retry] attempt %d of %d in %d seconds'
+                  % (attempt, retries, delay))
+        yield delay
+
+
+@contextlib.contextmanager
+def download_span(job):
+    """
+    TRACE span of the download of job, with its retries and the bytes it
+    added to the video file. The block sets its 'error'.
+    """
+    with TRACE.span('download', video_id=job['video_id']) as event:
+        size = file_size(job['filename']) or file_size(job['filename'] + '.part')
+        yield event
+        event['retries'] = job.get('attempts', 1) - 1
+        event['bytes'] = max(0, file_size(job['filename']) - size)
+
+
+def finish_download(job, success):
+    """
+    Records the downloaded video of job, or reports that its download
+    failed. Returns success.
+    """
+    if not success:
+        logging.warning('[warning] %s Download failed: %s'
+                        % (job['tag'], job['url']))
+        return False
+    record_download(job)
+    return True
+
+
+def run_download_job(job, bandwidth, retries, engine='subprocess'):
+    """
+    Download a single job within its share of the BandwidthController
+    bandwidth, retrying a failed download up to retries times with
+    exponential backoff. Returns True if the download succeeded.
+    """
+    for delay in download_attempts(job, retries):
+        time.sleep(delay)
+        if engine == 'inprocess':
+            if youtube_dl_download(job, bandwidth, reuse_info=job['attempts'] == 1):
+                return True
+        elif run_youtube_dl_limited(job['cmd'], job['tag'], bandwidth, id(job)) == 0:
+            return True
+    return False
+
+
+def record_download(job):
+    """ adds the downloaded video of job to its directory index and manifest """
+    if os.path.isfile(job['filename']):
+        job['dir_index'].add(job['filename'])
+    if job.get('manifest') and os.path.isfile(job['filename']):
+        job['manifest'].record_file(job['manifest_key'], job['video_id'],
+                                    job['filename'])
+
+
+class DownloadScheduler(object):
+    """
+    Global queue of the download jobs of all the courses, run by args.jobs
+    worker threads while the courses are still being crawled. Jobs are
+    handed out round robin across courses, so one large course does not
+    hold the others back, and the --rate-limit budget is shared among the
+    concurrent downloads (see BandwidthController). Unless --dedup is off,
+    a video already downloaded is linked instead (see ContentIndex), and
+    jobs of a video being downloaded wait for it.
+    """
+    def __init__(self, args, headers):
+        self.args = args
+        self.headers = headers
+        self.workers = max(1, args.jobs)
+        self.bandwidth = BandwidthController(args.ratelimit, self.workers)
+        self.results = []
+        self.contents = None
+        if args.dedup != 'off':
+            self.contents = ContentIndex(os.path.join(args.output_dir, CACHE_FILENAME))
+        self._fetching = set()
+        self._queues = collections.OrderedDict()
+        self._turn = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._threads = [threading.Thread(target=self._work)
+                         for _ in range(self.workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, course, job):
+        """ queues job of the given course """
+        with self._cond:
+            self._queues.setdefault(course, collections.deque()).append(job)
+            self._cond.notify()
+
+    def _next_job(self):
+        """ returns the next job, taking turns between courses, or None """
+        with self._cond:
+            while True:
+                courses = list(self._queues)
+                for i in range(len(courses)):
+                    queue = self._queues[courses[(self._turn + i) % len(courses)]]
+                    if queue:
+                        self._turn = (self._turn + i + 1) % len(courses)
+                        return queue.popleft()
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+    def _work(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                result = self.download(job)
+            except Exception as e:
+                logging.error('[error] %s %s' % (job['tag'], e))
+                result = False
+            with self._cond:
+                self.results.append(result)
+
+    def download(self, job):
+        """ downloads or links the video of job, returns True on success """
+        if self.contents is None:
+            return self._download(job)
+        key = (job['video_id'], job['format'])
+        with self._cond:
+            while key in self._fetching:
+                self._cond.wait()
+            self._fetching.add(key)
+        try:
+            if dedup_video(job, self.contents, self.args.dedup):
+                record_download(job)
+                return True
+            success = self._download(job)
+            if success and os.path.isfile(job['filename']):
+                self.contents.add(job['video_id'], job['format'], job['filename'])
+            return success
+        finally:
+            with self._cond:
+                self._fetching.discard(key)
+                self._cond.notify_all()
+
+    def _download(self, job):
+        args = self.args
+        with download_span(job) as event:
+            success = run_download_job(job, self.bandwidth, args.job_retries,
+                                       args.download_engine)
+            event['error'] = not success
+        return finish_download(job, success)
+
+    def wait(self):
+        """ waits for all the submitted jobs once no more will be submitted """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            # join with a timeout so that CTRL-C still reaches the main thread
+            while thread.is_alive():
+                thread.join(0.5)
+        if self.results:
+            logging.info('[info] Downloaded %d of %d videos'
+                         % (self.results.count(True), len(self.results)))
+
+
+class JobQueue(object):
+    """
+    SQLite queue of resolved videos (plan items) shared by several worker
+    processes, possibly on several hosts when the file is on shared
+    storage. A worker claims a job with a lease that it renews while the
+    download runs; the job of a worker that crashed is claimed again once
+    its lease expires. Jobs are keyed by their target path, so queueing the
+    same crawl twice does not duplicate them.
+
+    >>> queue = JobQueue(':memory:', lease=60)
+    >>> queue.add({'path': 'C/W/01-a.mp4'})
+    >>> queue.add({'path': 'C/W/01-a.mp4'})
+    >>> bprint(queue.claim('w1')['path'])
+    C/W/01-a.mp4
+    >>> queue.claim('w2') is None
+    True
+    >>> queue.finish('w1', 'C/W/01-a.mp4', True)
+    >>> queue.counts() == {'done': 1}
+    True
+
+    A job lost with its worker every time is given up after
+    QUEUE_MAX_ATTEMPTS claims:
+
+    >>> queue = JobQueue(':memory:', lease=-1)
+    >>> queue.add({'path': 'C/W/02-b.mp4'})
+    >>> [queue.claim('w%d' % i) is not None for i in range(QUEUE_MAX_ATTEMPTS + 1)]
+    [True, True, True, False]
+    >>> queue.counts() == {'failed': 1}
+    True
+    """
+    def __init__(self, path, lease=120):
+        self.path = path
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=HTTP_TIMEOUT,
+                                     isolation_level=None, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            path TEXT PRIMARY KEY, item TEXT, state TEXT, owner TEXT,
+            lease_until REAL, attempts INTEGER)""")
+
+    def _transaction(self, statements):
+        """ runs the (sql, parameters) of statements in one write transaction """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                for (sql, parameters) in statements:
+                    self._conn.execute(sql, parameters)
+                self._conn.execute('COMMIT')
+            except:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def add(self, item):
+        """ queues the plan item, unless its path is already queued """
+        self._transaction([("""INSERT OR IGNORE INTO jobs
+            (path, item, state, owner, lease_until, attempts)
+            VALUES (?, ?, 'pending', NULL, 0, 0)""",
+            (item['path'], json.dumps(item, sort_keys=True)))])
+
+    def close(self):
+        logging.info('[info] Job queue %s: %s' % (self.path, self.counts()))
+
+    def claim(self, owner):
+        """
+        returns the next pending job, or one whose lease expired, leased to
+        owner, or None if there is none right now. An expired job already
+        claimed QUEUE_MAX_ATTEMPTS times is marked failed instead.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                lost = self._conn.execute("""UPDATE jobs SET state = 'failed', owner = NULL,
+                    lease_until = 0
+                    WHERE state = 'running' AND lease_until < ? AND attempts >= ?""",
+                    (now, QUEUE_MAX_ATTEMPTS)).rowcount
+                row = self._conn.execute("""SELECT path, item FROM jobs
+                    WHERE state = 'pending' OR (state = 'running' AND lease_until < ?)
+                    ORDER BY rowid LIMIT 1""", (now,)).fetchone()
+                if row is not None:
+                    self._conn.execute("""UPDATE jobs SET state = 'running', owner = ?,
+                        lease_until = ?, attempts = attempts + 1 WHERE path = ?""",
+                        (owner, now + self.lease, row[0]))
+                self._conn.execute('COMMIT')
+            except:
+                self._conn.execute('ROLLBACK')
+                raise
+        if lost:
+            logging.warning('[warning] Gave up %d queued jobs lost with their '
+                            'worker %d times' % (lost, QUEUE_MAX_ATTEMPTS))
+        return json.loads(row[1]) if row is not None else None
+
+    def heartbeat(self, owner, paths):
+        """ renews the leases of owner on the jobs at paths """
+        until = time.time() + self.lease
+        self._transaction([("""UPDATE jobs SET lease_until = ?
+            WHERE path = ? AND owner = ? AND state = 'running'""", (until, path, owner))
+            for path in paths])
+
+    def finish(self, owner, path, success):
+        """
+        marks the job of owner at path done, or pending again after a
+        failure, until it has been tried QUEUE_MAX_ATTEMPTS times
+        """
+        self._transaction([("""UPDATE jobs SET owner = NULL, lease_until = 0,
+            state = CASE WHEN ? THEN 'done' WHEN attempts >= ? THEN 'failed'
+                         ELSE 'pending' END
+            WHERE path = ? AND owner = ?""",
+            (success, QUEUE_MAX_ATTEMPTS, path, owner))])
+
+    def counts(self):
+        """ returns the number of jobs in each state """
+        with self._lock:
+            return dict(self._conn.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def active(self):
+        """ returns True if jobs are pending or running """
+        counts = self.counts()
+        return bool(counts.get('pending') or counts.get('running'))
+
+
+def run_worker(args, headers):
+    """
+    Claim and download the videos of the job queue args.worker, args.jobs
+    at a time, until no job is pending or running anywhere. The leases of
+    the jobs being downloaded are renewed every third of the lease time.
+    """
+    queue = JobQueue(args.worker, args.worker_lease)
+    owner = '%s:%d' % (socket.gethostname(), os.getpid())
+    logging.info('[info] Worker %s on job queue %s: %s'
+                 % (owner, args.worker, queue.counts()))
+    scheduler = DownloadScheduler(args, headers)
+    manifests = {}
+    dir_indexes = {}
+    claimed = set()
+    lock = threading.Lock()
+    stopped = threading.Event()
+
+    def heartbeat():
+        while not stopped.wait(queue.lease / 3.0):
+            with lock:
+                paths = list(claimed)
+            queue.heartbeat(owner, paths)
+
+    def work():
+        while True:
+            item = queue.claim(owner)
+            if item is None:
+                if not queue.active():
+                    return
+                # running elsewhere, wait in case a lease expires
+                time.sleep(min(queue.lease / 3.0, 10))
                 continue
-                # sys.exit(0)
-
-            # Download Videos
-            c = 0
-            for v, s in zip(video_link, subsUrls):
-                c += 1
-                w_folder = validate_filename(w_name,"week " + str(current_week))
-                target_dir = os.path.join(args.output_dir,
-                                          validate_filename(selected_course[0],"course_folder"),w_folder)
-                filename_prefix = str(c).zfill(2)
-                cmd = ["youtube-dl",
-                       "-o", os.path.join(target_dir, filename_prefix + "-%(title)s.%(ext)s")]
-                if args.format:
-                    cmd.append("-f")
-                    # defaults to mp4 in case the requested format isn't available
-                    cmd.append(args.format + '/mp4')
-                if args.subtitles:
-                    cmd.append('--write-sub')
-                if args.ratelimit:
-                    cmd.append('--rate-limit='+args.ratelimit)
-                cmd.append(str(v))
-
-                file_renamed = False
-                if args.format:
-                    video_filename = youtube_get_filename(str(v), args.format + '/mp4').decode("utf-8")
-                else:
-                    video_filename = youtube_get_filename(str(v)).decode("utf-8", "22/mp4")
-                v_fn_template = os.path.join(target_dir, ("[0-9]" * len(filename_prefix)) + "-" + video_filename)
-                v_fn_exact = os.path.join(target_dir, str(filename_prefix) + "-" + video_filename)
-                logging.info("[info] Filename template:" + v_fn_template)
-                search_file = glob.glob(os.path.abspath(v_fn_template))
-
-                if (len(search_file) == 1) and (search_file[0] != v_fn_exact):
-                    logging.info("[info] Found with different index:" + search_file[0])
-                    file_renamed = True
-                    if not args.notrename:
-                        logging.info("[info] Rename to:" + v_fn_exact)
-                        os.rename(search_file[0], v_fn_exact)
-                    else:
-                        logging.info("[info] No action")
-
-                logging.info("[info] youtube-dl: " + ' '.join(cmd))
-
-                popen_youtube = Popen(cmd, stdout=PIPE, stderr=PIPE)
-
-                youtube_stdout = b''
-                enc = sys.getdefaultencoding()
-                while True:  # Save output to youtube_stdout while this being echoed
-                    tmp = popen_youtube.stdout.read(1)
-                    youtube_stdout += tmp
-                    print(tmp.decode(enc), end="")
-                    sys.stdout.flush()
-                    # do it until the process finish and there isn't output
-                    if tmp == b"" and popen_youtube.poll() is not None:
-                        break
-
-                if args.subtitles:
-                    filename = get_filename(target_dir, filename_prefix)
-                    if file_renamed:
-                        v_fn_old_sub = os.path.splitext(search_file[0])[0] + '.srt'
-                        v_fn_exact_sub = os.path.splitext(v_fn_exact)[0] + '.srt'
-                        if os.path.isfile(v_fn_old_sub):
-                            logging.info("[info] Rename subs to:" + v_fn_exact_sub)
-                            os.rename(v_fn_old_sub, v_fn_exact_sub)
-                    subs_filename = os.path.join(target_dir, filename + '.srt')
-                    if not os.path.exists(subs_filename):
-                        subs_string = edx_get_subtitle(s, headers)
-                        if subs_string:
-                            logging.info('Writing edX subtitles: %s' % subs_filename)
-                            open(os.path.join(os.getcwd(), subs_filename),
-                                 'wb+').write(subs_string.encode('utf-8'))
-                ## /week loop
-        ## /course loop
-
-def get_filename(target_dir, filename_prefix):
-    """ returns the basename for the corresponding filename_prefix """
-    # this whole function is not the nicest thing, but isolating it makes
-    # things clearer , a good refactoring would be to get
-    # the info from the video_url or the current output, to avoid the
-    # iteration from the current dir
-    filenames = os.listdir(target_dir)
-    # subs_filename = filename_prefix
-    for name in filenames:  # Find the filename of the downloaded video
-        if name.startswith(filename_prefix):
-            (basename, ext) = os.path.splitext(name)
-            return basename
+            with lock:
+                claimed.add(item['path'])
+                course_dir = os.path.join(args.output_dir, item['course_folder'])
+                target_dir = os.path.join(course_dir, item['week_folder'])
+                if course_dir not in manifests:
+                    manifests[course_dir] = CourseManifest(
+                        os.path.join(course_dir, MANIFEST_FILENAME))
+                if target_dir not in dir_indexes:
+                    dir_indexes[target_dir] = DirectoryIndex(target_dir)
+            success = False
+            try:
+                job = prepare_job(item, args, manifests[course_dir],
+                                  dir_indexes[target_dir])
+                success = scheduler.download(job)
+                if success and job['subtitles']:
+                    download_subtitles([job], args, headers)
+                    manifests[course_dir].save()
+            except Exception as e:
+                logging.error('[error] %s %s' % (item['path'], e))
+            finally:
+                with lock:
+                    claimed.discard(item['path'])
+                queue.finish(owner, item['path'], success)
+
+    beat = threading.Thread(target=heartbeat)
+    beat.daemon = True
+    beat.start()
+    parallel_map(lambda i: work(), range(max(1, args.jobs)), max(1, args.jobs))
+    stopped.set()
+    scheduler.wait()
+    queue.close()
+
+
+def legacy_unit_videos(page):
+    """
+    The split based unit page parser replaced by extract_unit_videos, kept
+    as the reference of the parse benchmark.
+    """
+    regexpSubs = re.compile(r'data-transcript-translation-url=(?:&#34;|")([^"&]*)(?:&#34;|")')
+    splitter = re.compile(r'data-streams=(?:&#34;|").*1.0[0]*:')
+    extra_youtube = re.compile(r'//w{0,3}\.youtube.com/embed/([^ \?&]*)[\?& ]')
+    records = []
+    for container in splitter.split(page)[1:]:
+        subs = regexpSubs.search(container)
+        records.append({'video_id': container[:YOUTUBE_VIDEO_ID_LENGTH],
+                        'transcript_url': subs.group(1) if subs else None})
+    for embed in extra_youtube.findall(page):
+        records.append({'video_id': embed[:YOUTUBE_VIDEO_ID_LENGTH],
+                        'transcript_url': None})
+    return records
+
+
+def sample_unit_page(videos=10, filler=20000, escaped=False, first=0):
+    """
+    Returns a synthetic unit page with videos video blocks, numbered from
+    first. If escaped, the blocks are HTML escaped on a single line, as in
+    sequence contents.
+    """
+    quote = '&#34;' if escaped else '"'
+    blocks = []
+    for i in range(first, first + videos):
+        blocks.append('<div class="xblock">%s</div>' % ('lorem ipsum ' * (filler // 12)))
+        blocks.append('<div class="video" data-streams=%s0.75:%s,1.0:%s,1.25:%s,1.50:%s%s '
+                      'data-transcript-translation-url=%s/courses/X/xblock/video%d/translation%s>'
+                      '</div>' % (quote, 'a%010d' % i, 'b%010d' % i, 'c%010d' % i,
+                                  'd%010d' % i, quote, quote, i, quote))
+        if i % 3 == 0:
+            blocks.append('<iframe src="//www.youtube.com/embed/%s?rel=0"></iframe>'
+                          % ('e%010d' % i))
+        if not escaped:
+            blocks.append('\n')
+    return ''.join(blocks)
+
+
+def sample_unit_videos(videos=10, first=0):
+    """ returns the records extract_unit_videos should find on a sample_unit_page """
+    records = [{'video_id': 'b%010d' % i,
+                'transcript_url': '/courses/X/xblock/video%d/translation' % i}
+               for i in range(first, first + videos)]
+    return records + [{'video_id': 'e%010d' % i, 'transcript_url': None}
+                      for i in range(first, first + videos) if i % 3 == 0]
+
+
+def sample_dashboard(courses):
+    """ returns a dashboard page of the benchmark user enrolled in courses """
+    return ('<ul><li></li></ul><ul><li><span></span><span>benchmark</span></li></ul>'
+            + ''.join('<article class="course"><a href="/courses/C%d/info">'
+                      '<h3>Course %d</h3></a></article>' % (c, c) for c in courses))
+
+
+def time_call(func, repeat):
+    """ returns the best time in seconds of repeat calls of func """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark_parse(args):
+    """
+    Time extract_unit_videos against the parser it replaced on the unit
+    pages of the page cache in the output dir (or on synthetic pages if it
+    has none), with the videos each finds. On synthetic pages, whose
+    videos are known, also check that the extractor finds all of them.
+    """
+    pages = []
+    cache_path = os.path.join(args.output_dir, CACHE_FILENAME)
+    if os.path.isfile(cache_path):
+        pages = PageCache(cache_path, 0).bodies('%/courseware/%')
+    source = '%d cached unit pages' % len(pages)
+    if not pages:
+        samples = [(videos, escaped) for videos in (0, 1, 5, 10, 30)
+                   for escaped in (False, True)]
+        pages = [sample_unit_page(videos, escaped=escaped) for (videos, escaped) in samples]
+        source = '%d synthetic unit pages' % len(pages)
+        wrong = [i for (i, (videos, escaped)) in enumerate(samples)
+                 if extract_unit_videos(pages[i]) != sample_unit_videos(videos)]
+        if wrong:
+            logging.warning('[benchmark] wrong videos found on pages %s' % wrong)
+    size = sum(len(page) for page in pages) / (1024.0 * 1024.0)
+    logging.info('[benchmark] parse: %s, %.2f MB' % (source, size))
+    for (name, parse) in [('legacy', legacy_unit_videos),
+                          ('extractor', extract_unit_videos)]:
+        found = sum(len(parse(page)) for page in pages)
+        elapsed = time_call(lambda: [parse(page) for page in pages], 50)
+        logging.info('[benchmark] %-12s %8.2f ms %8.1f MB/s %6d videos'
+                     % (name, elapsed * 1000, size / elapsed if elapsed else 0, found))
+
+
+def legacy_json2srt(o):
+    """
+    The string concatenation SRT converter replaced by write_subtitles,
+    kept as the reference of the srt benchmark.
+    """
+    from datetime import timedelta, datetime
+    i = 1
+    output = ''
+    for (s, e, t) in zip(o['start'], o['end'], o['text']):
+        if t == "":
+            continue
+        output += str(i) + '\n'
+        s = datetime(1, 1, 1) + timedelta(seconds=s/1000.)
+        e = datetime(1, 1, 1) + timedelta(seconds=e/1000.)
+        output += "%02d:%02d:%02d,%03d --> %02d:%02d:%02d,%03d" % \
+            (s.hour, s.minute, s.second, s.microsecond/1000,
+             e.hour, e.minute, e.second, e.microsecond/1000) + '\n'
+        output += t + "\n\n"
+        i += 1
+    return output
+
+
+def sample_transcript(cues=25000):
+    """
+    Returns a synthetic edX transcript of cues cues of about three seconds
+    each, some of them empty, as the edX transcript json decodes.
+    """
+    transcript = {'start': [], 'end': [], 'text': []}
+    for i in range(cues):
+        transcript['start'].append(i * 3000 + 120)
+        transcript['end'].append(i * 3000 + 2870)
+        transcript['text'].append('' if i % 50 == 0 else
+                                  'Sentence number %d of the lecture, as said by the teacher.' % i)
+    return transcript
+
+
+def mock_edx_server(pages, latency=0):
+    """
+    Starts and returns a local HTTP stand-in of an OpenEdX site serving the
+    login, the dashboard of the courses in pages ({course: {week: [unit
+    pages]}}), their courseware, unit pages and transcripts, each request
+    delayed by latency seconds.
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    transcript = json.dumps(sample_transcript(200))
+    units = dict(('/courses/C%d/courseware/w%d/u%d' % (c, w, u), page)
+                 for (c, weeks) in pages.items()
+                 for (w, unit_pages) in weeks.items()
+                 for (u, page) in enumerate(unit_pages))
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def send(self, body, content_type='text/html; charset=utf-8', cookie=None):
+            body = body.encode('utf-8')
+            self.send_response(200)
+            if cookie:
+                self.send_header('Set-Cookie', cookie)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            time.sleep(latency)
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send(json.dumps({'success': True}), 'application/json',
+                      'sessionid=benchmark; Path=/')
+
+        def do_GET(self):
+            time.sleep(latency)
+            path = self.path.split('?')[0]
+            match = re.match(r'/courses/C(\d+)/courseware$', path)
+            if path == '/login_ajax':
+                self.send('', cookie='csrftoken=benchmark; Path=/')
+            elif path == '/dashboard':
+                self.send(sample_dashboard(pages))
+            elif match:
+                c = int(match.group(1))
+                self.send('<nav aria-label="Course Navigation">%s</nav>' % ''.join(
+                    '<div><h3><a href="#">Week %d</a></h3><ul>%s</ul></div>'
+                    % (w, ''.join('<li><a href="/courses/C%d/courseware/w%d/u%d">Unit</a></li>'
+                                  % (c, w, u) for u in range(len(unit_pages))))
+                    for (w, unit_pages) in pages[c].items()))
+            elif path in units:
+                self.send(units[path])
+            elif path.endswith('/translation'):
+                self.send(transcript, 'application/json')
+            else:
+                self.send_error(404)
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+STUB_YOUTUBE_DL = """#!%s
+# stub youtube-dl of the crawl benchmark: writes the video id to the output file
+import os
+import sys
+args = sys.argv[1:]
+video_id = args[-1].split('=')[-1]
+path = args[args.index('-o') + 1].replace('%%(title)s', video_id).replace('%%(ext)s', 'mp4')
+if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+with open(path, 'w') as f:
+    f.write(video_id)
+"""
+
+
+def benchmark_crawl(args):
+    """
+    Run the whole flow (login, dashboard, courseware, unit pages, video
+    resolution, downloads and subtitles) against a local stand-in of an
+    OpenEdX site with a stub youtube-dl and the video info already cached,
+    using the concurrency options given, and report the crawl wall time,
+    the pages fetched per second and the peak memory.
+    """
+    import shutil
+    import tempfile
+    (courses, weeks, units, videos) = args.benchmark_size
+    pages = {}
+    for c in range(courses):
+        pages[c] = collections.OrderedDict()
+        for w in range(weeks):
+            pages[c][w] = [sample_unit_page(videos, first=((c * weeks + w) * units + u) * videos)
+                           for u in range(units)]
+    server = mock_edx_server(pages, args.benchmark_latency / 1000.0)
+    tmp_dir = tempfile.mkdtemp(prefix='edx-dl-benchmark-')
+    saved = (sys.argv, os.environ['PATH'], logging.getLogger().level)
+    try:
+        bin_dir = os.path.join(tmp_dir, 'bin')
+        os.makedirs(bin_dir)
+        stub = os.path.join(bin_dir, 'youtube-dl')
+        with open(stub, 'w') as f:
+            f.write(STUB_YOUTUBE_DL % sys.executable)
+        os.chmod(stub, 0o755)
+        os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+        output_dir = os.path.join(tmp_dir, 'out')
+        os.makedirs(output_dir)
+        cache = MetadataCache(os.path.join(output_dir, CACHE_FILENAME), 3600)
+        for weeks_pages in pages.values():
+            for unit_pages in weeks_pages.values():
+                for page in unit_pages:
+                    for record in extract_unit_videos(page):
+                        cache.put(record['video_id'], None,
+                                  {'title': record['video_id'], 'ext': 'mp4'},
+                                  record['video_id'] + '.mp4')
+
+        OPENEDX_SITES['benchmark'] = {
+            'url': 'http://127.0.0.1:%d' % server.server_port,
+            'courseware-selector': OPENEDX_SITES['edx']['courseware-selector'],
+        }
+        sys.argv = [sys.argv[0], '-x', 'benchmark', '-u', 'benchmark', '-p', 'benchmark',
+                    '-c', 'all', '-w', 'all', '-s', '-o', output_dir, '--session-file', '',
+                    '--course-workers', str(args.course_workers),
+                    '--fetch-workers', str(args.fetch_workers),
+                    '--jobs', str(args.jobs), '--parser', args.parser,
+                    '--request-rate', str(args.request_rate), '--engine', args.engine,
+                    '--async-connections', str(args.async_connections)]
+        logging.info('[benchmark] crawl: %d courses x %d weeks x %d units x %d videos, '
+                     '%d ms latency' % (courses, weeks, units, videos,
+                                        args.benchmark_latency))
+        logging.getLogger().setLevel(logging.WARNING)
+        start = time.time()
+        main()
+        elapsed = time.time() - start
+    finally:
+        (sys.argv, os.environ['PATH']) = saved[:2]
+        logging.getLogger().setLevel(saved[2])
+        server.shutdown()
+        shutil.rmtree(tmp_dir)
+
+    fetches = [event for event in TRACE.events
+               if event['stage'] in ('login', 'dashboard', 'courseware', 'unit', 'subtitle')]
+    downloads = [event for event in TRACE.events if event['stage'] == 'download']
+    crawl_time = max(event['start'] + event['duration']
+                     for event in fetches) - (start - TRACE.start)
+    logging.info('[benchmark] %d pages in %.2f s, %.1f pages/s'
+                 % (len(fetches), crawl_time, len(fetches) / crawl_time))
+    logging.info('[benchmark] %d downloads, done in %.2f s'
+                 % (len(downloads), elapsed))
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on mac os
+        peak /= 1024.0 * (1024.0 if sys.platform == 'darwin' else 1.0)
+        logging.info('[benchmark] peak memory %.1f MB' % peak)
+    except ImportError:
+        pass
+    for line in TRACE.summary()[:-1]:
+        logging.info('[benchmark] ' + line)
+
+
+def benchmark_srt(args):
+    """
+    Time the streaming subtitle writer against the converter it replaced
+    on a large synthetic transcript, writing to a temporary file, and
+    check that both write the same SRT.
+    """
+    import tempfile
+    transcript = sample_transcript()
+    if edx_json2srt(transcript) != legacy_json2srt(transcript):
+        logging.warning('[benchmark] srt writers disagree')
+    logging.info('[benchmark] srt: %d cues, %.2f MB'
+                 % (len(transcript['text']),
+                    len(edx_json2srt(transcript)) / (1024.0 * 1024.0)))
+
+    def legacy():
+        with tempfile.TemporaryFile() as f:
+            f.write(legacy_json2srt(transcript).encode('utf-8'))
+
+    def streaming(subtitle_format):
+        with tempfile.TemporaryFile() as raw:
+            with io.open(raw.fileno(), 'w', encoding='utf-8', newline='',
+                         closefd=False) as f:
+                write_subtitles(transcript, f, subtitle_format)
+
+    for (name, write) in [('legacy', legacy),
+                          ('srt', lambda: streaming('srt')),
+                          ('vtt', lambda: streaming('vtt'))]:
+        elapsed = time_call(write, 5)
+        logging.info('[benchmark] %-12s %8.2f ms %8.0f cues/s'
+                     % (name, elapsed * 1000,
+                        len(transcript['text']) / elapsed if elapsed else 0))
+
+
+def benchmark_startup(args):
+    """
+    Time a whole run of --offline --list-enrolled in a new interpreter
+    against a dashboard in the page cache of a temporary output dir, as
+    scripts calling the tool repeatedly see it, and report which of the
+    slow to import dependencies that run loaded.
+    """
+    import shutil
+    import tempfile
+    tmp_dir = tempfile.mkdtemp(prefix='edx-dl-benchmark-')
+    try:
+        change_openedx_site(args.platform)
+        raw_headers = b'Content-Type: text/html; charset=utf-8\r\n\r\n'
+        response = SessionResponse(DASHBOARD, 200, 'OK', parse_headers(io.BytesIO(raw_headers)),
+                                   sample_dashboard(range(20)).encode('utf-8'))
+        PageCache(os.path.join(tmp_dir, CACHE_FILENAME), 1024 * 1024).put(DASHBOARD, response)
+        argv = [os.path.abspath(sys.argv[0]), '-x', args.platform, '--offline', '-e',
+                '-o', tmp_dir, '--parser', args.parser]
+        # runs the script as __main__ and prints the dependencies it imported
+        probe = ('import json, runpy, sys\n'
+                 'sys.argv = %r\n'
+                 'try:\n'
+                 '    runpy.run_path(sys.argv[0], run_name="__main__")\n'
+                 'except SystemExit:\n'
+                 '    pass\n'
+                 'sys.stdout.write(json.dumps([name for name in %r if name in sys.modules]))\n'
+                 % (argv, ['youtube_dl', 'bs4', 'lxml', 'html5lib']))
+
+        def run(cmd):
+            process = Popen(cmd, stdout=PIPE, stderr=PIPE)
+            (out, err) = process.communicate()
+            if process.returncode != 0:
+                raise RuntimeError(err.decode('utf-8', 'replace'))
+            return out
+        interpreter = time_call(lambda: run([sys.executable, '-c', 'pass']), 5)
+        listing = time_call(lambda: run([sys.executable] + argv), 5)
+        imported = json.loads(run([sys.executable, '-c', probe]).decode('utf-8').splitlines()[-1])
+    finally:
+        shutil.rmtree(tmp_dir)
+    logging.info('[benchmark] interpreter startup: %.3f s' % interpreter)
+    logging.info('[benchmark] --offline --list-enrolled: %.3f s' % listing)
+    logging.info('[benchmark] imported: %s' % (', '.join(imported) or 'none'))
+
+
+BENCHMARKS = {
+    'parse': benchmark_parse,
+    'srt': benchmark_srt,
+    'crawl': benchmark_crawl,
+    'startup': benchmark_startup,
+}
+
 
 if __name__ == '__main__':
     logging.basicConfig(level = logging.DEBUG, format = '%(message)s')
@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+
+"""
+Asyncio engine of edx-dl, selected with --engine async (python 3.7+).
+
+The login, the dashboard, the courseware, the unit pages and the
+transcripts are fetched as coroutines on a single event loop, with at most
+--async-connections requests in flight, over keep-alive connections of
+its own. youtube-dl runs as asyncio subprocesses fed from a download queue,
+--jobs at a time. Parsing, planning and the on-disk bookkeeping (plan
+items, course manifests, directory indexes, subtitle files) are the ones
+of edx-dl.py, which is passed to run() as a module.
+"""
+
+import asyncio
+import io
+import json
+import logging
+import os
+import re
+import ssl
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+from http.client import parse_headers
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode, urljoin, urlsplit
+from urllib.request import Request
+
+
+class AsyncSession(object):
+    """
+    Asyncio counterpart of EdxSession: cookie jar, default headers, pooled
+    keep-alive connections, page cache, request governor and retries, with
+    the same urlopen-like errors. At most limit requests are in flight.
+    """
+    MAX_REDIRECTS = 10
+
+    def __init__(self, edx, limit, headers=None):
+        self.edx = edx
+        self.cookies = CookieJar()
+        self.headers = dict(headers or {})
+        self.page_cache = None
+        self.offline = False
+        self.governor = None
+        self.bandwidth = None
+        self.retries = 0
+        self._idle = {}
+        self._limit = asyncio.Semaphore(limit)
+
+    def get_cookie(self, name):
+        for cookie in self.cookies:
+            if cookie.name == name:
+                return cookie.value
+        return None
+
+    def close(self):
+        """ closes all the idle connections of the pool """
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for (reader, writer) in connections:
+                writer.close()
+
+    async def _connect(self, scheme, netloc):
+        """ returns ((reader, writer), reused) for the given host """
+        idle = self._idle.get((scheme, netloc))
+        if idle:
+            return (idle.pop(), True)
+        (host, _, port) = netloc.partition(':')
+        https = scheme == 'https'
+        connection = await asyncio.wait_for(
+            asyncio.open_connection(host, int(port or (443 if https else 80)),
+                                    ssl=ssl.create_default_context() if https else None),
+            self.edx.HTTP_TIMEOUT)
+        return (connection, False)
+
+    async def _read_response(self, reader, method):
+        """ returns (status, reason, headers, body, will_close) """
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed by the server')
+        (version, status, reason) = (status_line.decode('latin-1').rstrip('\r\n')
+                                     .split(' ', 2) + [''])[:3]
+        raw_headers = b''
+        while True:
+            line = await reader.readline()
+            raw_headers += line
+            if line in (b'\r\n', b'\n', b''):
+                break
+        headers = parse_headers(io.BytesIO(raw_headers))
+        status = int(status)
+        will_close = (headers.get('Connection', '').lower() == 'close' or
+                      version == 'HTTP/1.0')
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                if size == 0:
+                    # skip the trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif headers.get('Content-Length') is not None:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            body = await reader.read()
+            will_close = True
+        return (status, reason, headers, body, will_close)
+
+    async def _send(self, url, data, headers):
+        """ sends the request over a pooled connection and reads the response """
+        (scheme, netloc, path, query, fragment) = urlsplit(url)
+        selector = (path or '/') + ('?' + query if query else '')
+        request = Request(url, data, headers)
+        self.cookies.add_cookie_header(request)
+        method = 'POST' if data is not None else 'GET'
+        lines = ['%s %s HTTP/1.1' % (method, selector), 'Host: %s' % netloc,
+                 'Accept-Encoding: identity']
+        lines += ['%s: %s' % header for header in request.header_items()]
+        if data is not None:
+            lines.append('Content-Length: %d' % len(data))
+        raw_request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (data or b'')
+        while True:
+            ((reader, writer), reused) = await self._connect(scheme, netloc)
+            try:
+                writer.write(raw_request)
+                await writer.drain()
+                (status, reason, msg, body, will_close) = await asyncio.wait_for(
+                    self._read_response(reader, method), self.edx.HTTP_TIMEOUT)
+            except (OSError, ValueError, asyncio.IncompleteReadError,
+                    asyncio.TimeoutError) as e:
+                writer.close()
+                if reused:
+                    # the server closed the idle connection, try a new one
+                    continue
+                raise URLError(e)
+            break
+        if will_close:
+            writer.close()
+        else:
+            self._idle.setdefault((scheme, netloc), []).append((reader, writer))
+        response = self.edx.SessionResponse(url, status, reason, msg, body)
+        self.cookies.extract_cookies(response, request)
+        return response
+
+    async def _follow(self, url, data, headers):
+        """ sends the request and follows its redirections """
+        for _ in range(self.MAX_REDIRECTS + 1):
+            response = await self._send(url, data, headers)
+            location = response.headers.get('Location')
+            if response.code not in (301, 302, 303, 307, 308) or not location:
+                break
+            url = urljoin(url, location)
+            if response.code in (301, 302, 303):
+                data = None
+        return response
+
+    async def open(self, url, data=None, headers=None, cache=True):
+        """ same as EdxSession.open """
+        edx = self.edx
+        (request_headers, cache, cached) = edx.prepare_request(self, url, data, headers, cache)
+        if self.offline:
+            return cached[0]
+        attempt = 0
+        while True:
+            if self.governor is not None:
+                wait = self.governor.reserve()
+                while wait > 0:
+                    await asyncio.sleep(wait)
+                    wait = self.governor.reserve()
+            (response, error) = (None, None)
+            try:
+                async with self._limit:
+                    response = await self._follow(url, data, request_headers)
+            except URLError as e:
+                error = e
+            if response is not None and self.bandwidth is not None:
+                await asyncio.sleep(self.bandwidth.reserve(len(response.body)))
+            delay = edx.retry_wait(self, url, response, error, attempt)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+            attempt += 1
+        return edx.finish_response(self, url, response, error, attempt, cache, cached)
+
+    async def get_page_contents(self, url, stage='page'):
+        """ same as get_page_contents """
+        logging.debug("[debug] url = " + url)
+        with self.edx.TRACE.span(stage, url=url) as event:
+            result = await self.open(url)
+            body = result.read()
+            event['bytes'] = len(body)
+            event['retries'] = getattr(result, 'retries', 0)
+        return body.decode(result.headers.get_content_charset('utf-8'))
+
+
+async def run_youtube_dl(edx, cmd, tag, on_progress=None):
+    """
+    Asyncio counterpart of run_youtube_dl: runs youtube-dl as a subprocess
+    and relays its output and progress tagged with the job, stopping it when
+    on_progress, if given, returns True for a progress event.
+    """
+    logging.info("[info] youtube-dl: " + ' '.join(cmd))
+    process = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    progress = edx.JobProgress(tag)
+    enc = sys.getdefaultencoding()
+
+    def handle_stdout(line):
+        event = edx.parse_progress(line)
+        if event is None:
+            edx.job_print(tag, line)
+            return
+        progress.update(event)
+        if on_progress is not None and on_progress(event):
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                # it already exited
+                pass
+
+    async def relay(stream, handle_line):
+        pending = b''
+        while True:
+            chunk = await stream.read(65536)
+            if not chunk:
+                break
+            lines = re.split(b'[\r\n]', pending + chunk)
+            pending = lines.pop()
+            for line in lines:
+                if line.strip():
+                    handle_line(line.decode(enc, 'replace'))
+        if pending.strip():
+            handle_line(pending.decode(enc, 'replace'))
+
+    await asyncio.gather(relay(process.stdout, handle_stdout),
+                         relay(process.stderr, lambda line: edx.job_print(tag, line)))
+    return await process.wait()
+
+
+class AsyncEngine(object):
+    """
+    Crawls the selected courses and downloads their videos and subtitles
+    on one event loop, see the module docstring.
+    """
+    def __init__(self, edx, args):
+        self.edx = edx
+        self.args = args
+        self.session = None
+        self.executor = ThreadPoolExecutor(max(1, args.fetch_workers))
+        self.downloads = None
+        self.plan = None
+        self.metadata_cache = None
+        self.contents = None
+        self.fetching = {}
+        self.bandwidth = edx.BandwidthController(args.ratelimit, max(1, args.jobs))
+        self.results = []
+
+    def blocking(self, func, *args):
+        """ runs func(*args) in the thread pool """
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def login(self, headers):
+        edx = self.edx
+        session = self.session
+        with edx.TRACE.span('login', url=edx.EDX_HOMEPAGE) as event:
+            event['bytes'] = len((await session.open(edx.EDX_HOMEPAGE, cache=False)).read())
+        headers['X-CSRFToken'] = session.get_cookie('csrftoken') or ''
+        post_data = urlencode({'email': self.args.username, 'password': self.args.password,
+                               'remember': False}).encode('utf-8')
+        with edx.TRACE.span('login', url=edx.LOGIN_API) as event:
+            body = (await session.open(edx.LOGIN_API, post_data, headers)).read()
+            event['bytes'] = len(body)
+        resp = json.loads(body.decode('utf-8'))
+        if not resp.get('success', False):
+            logging.error(resp.get('value', "Wrong Email or Password."))
+            sys.exit(2)
+
+    def select(self, numbers, available):
+        """ returns the numbers selected by -c/-w, all of them for "all" """
+        if numbers == [0]:
+            return list(range(1, available + 1))
+        return [n for n in numbers if 1 <= n <= available]
+
+    async def main(self):
+        edx = self.edx
+        args = self.args
+        headers = {
+            'User-Agent': edx.USER_AGENT,
+            'Accept': 'application/json, text/javascript, */*; q=0.01',
+            'Content-Type': 'application/x-www-form-urlencoded;charset=utf-8',
+            'Referer': edx.EDX_HOMEPAGE,
+            'X-Requested-With': 'XMLHttpRequest',
+        }
+        self.session = session = AsyncSession(edx, args.async_connections)
+        if args.page_cache_size > 0:
+            session.page_cache = edx.PageCache(
+                os.path.join(args.output_dir, edx.CACHE_FILENAME),
+                args.page_cache_size * 1024 * 1024)
+        session.offline = args.offline
+        session.governor = edx.RequestGovernor(args.request_rate)
+        if args.edx_ratelimit:
+            session.bandwidth = edx.BandwidthController(args.edx_ratelimit)
+        session.retries = args.request_retries
+        store = None
+        resumed = False
+        if not args.offline:
+            if args.session_file:
+                store = edx.SessionStore(args.session_file)
+                csrftoken = store.load(args.username, session.cookies)
+                resumed = csrftoken is not None
+                if resumed:
+                    headers['X-CSRFToken'] = csrftoken
+            if not resumed:
+                await self.login(headers)
+        session.headers.update(headers)
+
+        try:
+            dash = await session.get_page_contents(edx.DASHBOARD, 'dashboard')
+        except HTTPError as e:
+            if not resumed or e.code not in (401, 403):
+                raise
+            logging.info('[info] The saved session was rejected, logging in again')
+            session.cookies.clear()
+            await self.login(headers)
+            session.headers.update(headers)
+            dash = await session.get_page_contents(edx.DASHBOARD, 'dashboard')
+        if store is not None:
+            store.save(args.username, session.cookies, headers['X-CSRFToken'])
+        soup = edx.make_soup(dash, args.parser, ['ul', 'article'])
+        (username, courses) = edx.parse_dashboard(soup)
+        logging.info('Welcome %s' % username)
+        logging.info('You can access %d courses' % len(courses))
+        for (c, course) in enumerate(courses, 1):
+            logging.info('%d - %s -> %s' % (c, course[0], course[2]))
+        if args.list_enrolled:
+            return
+
+        course_loop = [c for (c, course) in enumerate(courses, 1)
+                       if args.course_id and
+                       course[1].rstrip('/') == args.course_id.rstrip('/')]
+        if not course_loop and args.course_number:
+            course_loop = self.select(args.course_number, len(courses))
+
+        if args.metadata_ttl > 0:
+            self.metadata_cache = edx.MetadataCache(
+                os.path.join(args.output_dir, edx.CACHE_FILENAME),
+                args.metadata_ttl * 3600, args.metadata_cache_size)
+        if args.dedup != 'off':
+            self.contents = edx.ContentIndex(os.path.join(args.output_dir, edx.CACHE_FILENAME))
+        if args.queue:
+            self.plan = edx.JobQueue(args.queue)
+        elif args.plan_out:
+            self.plan = edx.PlanWriter(args.plan_out)
+
+        self.downloads = asyncio.Queue()
+        workers = [asyncio.ensure_future(self.download_worker())
+                   for _ in range(max(1, args.jobs))]
+        await asyncio.gather(*[self.crawl_course(c, courses[c - 1]) for c in course_loop])
+        for _ in workers:
+            self.downloads.put_nowait(None)
+        await asyncio.gather(*workers)
+        session.close()
+        self.executor.shutdown()
+        if self.plan is not None:
+            self.plan.close()
+        if self.results:
+            logging.info('[info] Downloaded %d of %d videos'
+                         % (self.results.count(True), len(self.results)))
+
+    async def crawl_course(self, current_course, course):
+        """ crawls the selected weeks of course, same as crawl_course """
+        edx = self.edx
+        args = self.args
+        (course_name, course_url, state) = course
+        logging.info("[info] Using course %d: %s" % (current_course, course_name))
+        if state != 'Started':
+            logging.info("[info] Course %d: %s is not started yet"
+                         % (current_course, course_name))
+            return
+        courseware = await self.session.get_page_contents(
+            course_url.replace('info', 'courseware'), 'courseware')
+        soup = edx.make_soup(courseware, args.parser, *edx.COURSEWARE_SEL)
+        weeks = edx.parse_courseware(soup)
+        logging.info('%s has %d weeks so far' % (course_name, len(weeks)))
+        for (w, week) in enumerate(weeks, 1):
+            logging.info('%d - Download %s videos' % (w, week[0].strip()))
+        if args.list_weeks:
+            return
+        week_loop = self.select(args.week, len(weeks))
+
+        course_folder = edx.validate_filename(course_name, "course_folder")
+        course_dir = os.path.join(args.output_dir, course_folder)
+        manifest = edx.CourseManifest(os.path.join(course_dir, edx.MANIFEST_FILENAME))
+
+        week_links = [link for current_week in week_loop
+                      for link in weeks[current_week - 1][1]]
+
+        async def fetch_unit(link):
+            logging.info("[info] Processing '%s'..." % link)
+            return await self.session.get_page_contents(link, 'unit')
+
+        pages = dict(zip(week_links, await asyncio.gather(*[fetch_unit(link)
+                                                             for link in week_links])))
+        await asyncio.gather(*[self.crawl_week(current_course, course_name, course_folder,
+                                               current_week, weeks[current_week - 1],
+                                               pages, manifest)
+                               for current_week in week_loop])
+        manifest.save()
+
+    async def crawl_week(self, current_course, course_name, course_folder,
+                         current_week, week, pages, manifest):
+        """ resolves the videos of a week and queues their downloads """
+        edx = self.edx
+        args = self.args
+        (w_name, links) = (week[0].strip(), week[1])
+        (video_ids, subs_urls) = edx.week_videos(links, pages, manifest)
+        if not video_ids:
+            logging.warning('WARNING: No downloadable video found.')
+            return
+        w_folder = edx.validate_filename(w_name, "week " + str(current_week))
+        target_dir = os.path.join(args.output_dir, course_folder, w_folder)
+        dir_index = edx.DirectoryIndex(target_dir) if self.plan is None else None
+        subtitle_langs = args.subtitle_langs if args.subtitles else []
+        video_format = args.format + '/mp4' if args.format else None
+
+        async def resolve(c, v_id, subs_url):
+            filename_prefix = str(c).zfill(2)
+            manifest_key = w_folder + '/' + filename_prefix
+            if args.offline:
+                logging.info("[info] Offline, not downloading %s to %s" % (v_id, target_dir))
+                return None
+            if args.sync and manifest.is_complete(manifest_key, v_id, subs_url,
+                                                  subtitle_langs, args.subtitle_format,
+                                                  args.verify):
+                logging.info("[info] Already downloaded: %s %s" % (manifest_key, v_id))
+                return None
+            (video_filename, video_info) = await self.blocking(
+                edx.resolve_video, v_id, 'http://youtube.com/watch?v=' + v_id,
+                video_format, args.subtitles, self.metadata_cache)
+            return edx.plan_item(course_name, current_course, course_folder, current_week,
+                                 w_folder, filename_prefix, v_id, subs_url, video_format,
+                                 video_filename, args.subtitles)
+
+        items = await asyncio.gather(*[resolve(c, v_id, subs_url) for (c, v_id, subs_url)
+                                       in zip(range(1, len(video_ids) + 1), video_ids,
+                                              subs_urls)])
+        jobs = []
+        for item in items:
+            if item is None:
+                continue
+            if self.plan is not None:
+                self.plan.add(item)
+                continue
+            job = edx.prepare_job(item, args, manifest, dir_index)
+            jobs.append(job)
+            self.downloads.put_nowait(job)
+        if args.subtitles and jobs:
+            await asyncio.gather(*[self.fetch_subtitle(*task)
+                                   for task in edx.subtitle_tasks(jobs, args)])
+
+    async def fetch_subtitle(self, url, subs_filename, job):
+        """ fetches, converts and writes a subtitle file, like download_subtitles """
+        try:
+            transcript = json.loads(await self.session.get_page_contents(url, 'subtitle'))
+        except URLError as e:
+            logging.warning('[warning] edX subtitles (error:%s)' % e.reason)
+            return
+        self.edx.write_subtitle_file(transcript, subs_filename, job, self.args)
+
+    async def download_worker(self):
+        """ downloads the queued jobs until it gets None """
+        while True:
+            job = await self.downloads.get()
+            if job is None:
+                return
+            try:
+                success = await self.fetch(job)
+            except Exception as e:
+                logging.error('[error] %s %s' % (job['tag'], e))
+                success = False
+            self.results.append(success)
+
+    async def fetch(self, job):
+        """ downloads or links the video of job, returns True on success """
+        edx = self.edx
+        if self.contents is None:
+            return await self.download(job)
+        # jobs of a video being downloaded wait for it, then link it
+        key = (job['video_id'], job['format'])
+        while key in self.fetching:
+            await self.fetching[key].wait()
+        self.fetching[key] = asyncio.Event()
+        try:
+            if await self.blocking(edx.dedup_video, job, self.contents, self.args.dedup):
+                await self.blocking(edx.record_download, job)
+                return True
+            success = await self.download(job)
+            if success and os.path.isfile(job['filename']):
+                await self.blocking(self.contents.add, job['video_id'],
+                                    job['format'], job['filename'])
+            return success
+        finally:
+            self.fetching.pop(key).set()
+
+    async def download(self, job):
+        """ downloads the video of job with youtube-dl, returns True on success """
+        edx = self.edx
+        with edx.download_span(job) as event:
+            for delay in edx.download_attempts(job, self.args.job_retries):
+                await asyncio.sleep(delay)
+                success = await self.run_youtube_dl_limited(job) == 0
+                if success:
+                    break
+            event['error'] = not success
+        return await self.blocking(edx.finish_download, job, success)
+
+
+    async def run_youtube_dl_limited(self, job):
+        """ same as run_youtube_dl_limited """
+        edx = self.edx
+        rate = self.bandwidth.start(id(job), fixed=True)
+        try:
+            while True:
+                watch = edx.RateWatch(self.bandwidth, id(job), job['tag'])
+                status = await run_youtube_dl(edx, edx.rate_limited_cmd(job['cmd'], rate),
+                                              job['tag'], watch)
+                if not watch.restart:
+                    return status
+                rate = watch.rate
+        finally:
+            self.bandwidth.finish(id(job))
+
+
+def run(edx, args):
+    """ runs the asyncio engine with the module edx-dl.py as edx """
+    asyncio.run(AsyncEngine(edx, args).main())